@@ -0,0 +1,252 @@
+#!/usr/bin/env python3.6
+
+import json
+import time
+import platform
+import argparse
+from pathlib import Path
+from statistics import median
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Dict, List, Tuple
+
+import torch
+import numpy as np
+import torch.nn.functional as F
+from torch import nn, Tensor
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from dataloader import get_loaders
+from utils import class2one_hot, get_validation_level
+
+
+NETWORKS: List[str] = ["ENet", "UNet", "fcn8s"]
+SHAPES: List[Tuple[int, int]] = [(256, 256), (256, 36)]  # Full slices, and the ones resized by --resize=36
+LOSSES: List[Tuple[str, Dict]] = [("CrossEntropy", {'idc': [0, 1], 'weights': [1, 1], 'fn': None}),
+                                  ("NaivePenalty", {'idc': [1], 'fn': 'soft_size'}),
+                                  ("NaivePenalty", {'idc': [1], 'fn': 'soft_size', 'fused': False})]
+BOUNDS: List[Tuple[str, Dict]] = [("ConstantBounds", {'values': {0: [0, 0], 1: [60, 2000]}}),
+                                  ("TagBounds", {'values': {0: [0, 0], 1: [60, 2000]}, 'idc': [1]}),
+                                  ("PreciseBounds", {'margin': 0.1, 'mode': 'percentage', 'fn': 'soft_size'}),
+                                  ("PreciseTags", {'margin': 0.1, 'mode': 'percentage', 'fn': 'soft_size',
+                                                   'neg_value': [0, 0]}),
+                                  ("BoxBounds", {'margins': [0.7, 0.9]})]
+
+
+def sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def timeit(fn: Callable[[], Any], device: torch.device, warmup: int, repeat: int) -> Dict[str, float]:
+    for _ in range(warmup):
+        fn()
+    sync(device)
+
+    times: List[float] = []
+    for _ in range(repeat):
+        tic: float = time.perf_counter()
+        fn()
+        sync(device)
+        times.append(time.perf_counter() - tic)
+
+    return {"median_ms": 1000 * median(times), "min_ms": 1000 * min(times)}
+
+
+def synthetic_batch(batch_size: int, C: int, shape: Tuple[int, int], device: torch.device) -> Tuple[Tensor, Tensor]:
+    # Random images, with an ellipse of foreground in the middle of each slice
+    w, h = shape
+    xx, yy = np.mgrid[:w, :h]
+    mask: np.ndarray = ((xx - w / 2) / (w / 4)) ** 2 + ((yy - h / 2) / (h / 4)) ** 2 <= 1
+    image: Tensor = torch.rand((batch_size, 1, w, h), device=device)
+    labels: Tensor = torch.from_numpy(mask.astype(np.int64)).to(device).expand(batch_size, w, h)
+
+    return image, class2one_hot(labels, C)
+
+
+def bench_networks(args: argparse.Namespace, device: torch.device) -> List[Dict]:
+    records: List[Dict] = []
+    for name in args.networks:
+        for shape in SHAPES:
+            record: Dict[str, Any] = {"bench": "network", "name": name, "shape": list(shape),
+                                      "batch_size": args.batch_size}
+            try:
+                # No apply: fcn8s would download the vgg16 weights
+                net: nn.Module = getattr(__import__('networks'), name)(1, args.n_class).to(device)
+                image, target = synthetic_batch(args.batch_size, args.n_class, shape, device)
+                optimizer = torch.optim.Adam(net.parameters(), lr=1e-4)
+
+                def forward() -> None:
+                    with torch.no_grad():
+                        net(image)
+
+                def forward_backward() -> None:
+                    optimizer.zero_grad()
+                    logits: Tensor = net(image)
+                    F.cross_entropy(logits, target.argmax(dim=1)).backward()
+                    optimizer.step()
+
+                net.eval()
+                fwd = timeit(forward, device, args.warmup, args.repeat)
+                net.train()
+                train = timeit(forward_backward, device, args.warmup, args.repeat)
+
+                record.update({"forward_ms": fwd["median_ms"],
+                               "forward_img_s": 1000 * args.batch_size / fwd["median_ms"],
+                               "train_ms": train["median_ms"],
+                               "train_img_s": 1000 * args.batch_size / train["median_ms"]})
+            except Exception as e:  # Some networks do not support every shape: record it and carry on
+                record["error"] = f"{e.__class__.__name__}: {e}"
+            records.append(record)
+
+    return records
+
+
+def bench_losses(args: argparse.Namespace, device: torch.device) -> List[Dict]:
+    records: List[Dict] = []
+    for shape in SHAPES:
+        _, target = synthetic_batch(args.batch_size, args.n_class, shape, device)
+        logits: Tensor = torch.randn((args.batch_size, args.n_class, *shape), device=device, requires_grad=True)
+        w, h = shape
+        bounds: Tensor = torch.tensor([[0, w * h], [0.1 * w * h, 0.2 * w * h]], device=device)
+        bounds = bounds[None, :, None, :].expand(args.batch_size, args.n_class, 1, 2)
+
+        for name, params in LOSSES:
+            loss_fn = getattr(__import__('losses'), name)(**params, dtype=torch.float32)
+
+            def call() -> None:
+                logits.grad = None
+                loss_fn(F.softmax(logits, dim=1), target, bounds).backward()
+
+            records.append({"bench": "loss", "name": name, "params": repr(params), "shape": list(shape),
+                            "batch_size": args.batch_size, **timeit(call, device, args.warmup, args.repeat)})
+
+    return records
+
+
+def bench_bounds(args: argparse.Namespace, device: torch.device) -> List[Dict]:
+    records: List[Dict] = []
+    for shape in SHAPES:
+        # Bounds are computed per sample, in the dataloader workers: on cpu and without batch dim
+        image, target = synthetic_batch(1, args.n_class, shape, torch.device("cpu"))
+
+        for name, params in BOUNDS:
+            bounds_fn = getattr(__import__('bounds'), name)(C=args.n_class, **{'fn': None, **params})
+
+            def call() -> None:
+                bounds_fn(image[0], target[0], target[0], "Case00_0_000.png")
+
+            records.append({"bench": "bounds", "name": name, "shape": list(shape),
+                            **timeit(call, torch.device("cpu"), args.warmup, args.repeat)})
+
+    return records
+
+
+def write_synthetic_dataset(root: Path, n_patients: int, n_slices: int, shape: Tuple[int, int]) -> None:
+    rng = np.random.RandomState(0)
+    for split in ["train", "val"]:
+        for folder in ["IMG", "GT"]:
+            Path(root, split, folder).mkdir(parents=True, exist_ok=True)
+
+        for p in range(n_patients):
+            for s in range(n_slices):
+                name: str = f"Case{p:02d}_0_{s:03d}.png"
+                image: np.ndarray = rng.randint(0, 256, size=shape, dtype=np.uint8)
+                gt: np.ndarray = (image > 200).astype(np.uint8)  # Class indices, as the gt_transform expects
+                Image.fromarray(image).save(Path(root, split, "IMG", name))
+                Image.fromarray(gt).save(Path(root, split, "GT", name))
+
+
+def bench_data(args: argparse.Namespace, device: torch.device) -> List[Dict]:
+    records: List[Dict] = []
+    with TemporaryDirectory() as tmp:
+        write_synthetic_dataset(Path(tmp), args.n_patients, args.n_slices, SHAPES[0])
+
+        # Same losses as the README: the PreciseBounds are computed in the workers, as in training
+        losses: str = ("[('CrossEntropy', {'idc': [0, 1], 'weights': [1, 1]}, None, None, None, 1),"
+                       " ('NaivePenalty', {'idc': [1]}, 'PreciseBounds', {'margin': 0.1, 'mode': 'percentage'},"
+                       " 'soft_size', 1)]")
+        loader_args = argparse.Namespace(losses=losses, n_class=args.n_class, grp_regex="Case\\d+_\\d+",
+                                         packed=False, bounds_table=False, bounds_on_fgt=False,
+                                         bounds_on_train_stats='', train_sampler="random", val_batch_size=0,
+                                         seed=0, num_workers=0, pin_memory=False, persistent_workers=False,
+                                         prefetch_factor=2, resize=0)
+        folders: str = "[('IMG', png_transform, False), ('GT', gt_transform, False), ('GT', gt_transform, False)]"
+        train_loader, _ = get_loaders(loader_args, tmp, folders, args.batch_size, args.n_class,
+                                      False, False, torch.float32, True)
+        dataset = train_loader.dataset
+
+        for workers in args.workers:
+            loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, drop_last=True,
+                                num_workers=workers, pin_memory=device.type == "cuda")
+
+            tic: float = time.perf_counter()
+            iterator = iter(loader)
+            next(iterator)  # Time to the first batch, with the worker startup
+            first: float = time.perf_counter() - tic
+
+            n: int = args.batch_size
+            for batch in iterator:
+                n += len(batch[0])
+            total: float = time.perf_counter() - tic
+
+            records.append({"bench": "data", "name": "SliceDataset", "workers": workers,
+                            "batch_size": args.batch_size, "samples": n, "first_batch_s": first,
+                            "samples_s": (n - args.batch_size) / max(total - first, 1e-9)})
+
+    return records
+
+
+SECTIONS: Dict[str, Callable[[argparse.Namespace, torch.device], List[Dict]]] = {"networks": bench_networks,
+                                                                                 "losses": bench_losses,
+                                                                                 "bounds": bench_bounds,
+                                                                                 "data": bench_data}
+
+
+def main(args: argparse.Namespace) -> None:
+    torch.manual_seed(0)
+    device = torch.device("cpu") if args.cpu or not torch.cuda.is_available() else torch.device("cuda")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    # Shared by all the records, to compare runs across machines and versions
+    context: Dict[str, Any] = {"date": time.strftime("%Y-%m-%dT%H:%M:%S"), "host": platform.node(),
+                               "torch": torch.__version__, "device": str(device),
+                               "device_name": torch.cuda.get_device_name(device) if device.type == "cuda" else
+                               platform.processor(),
+                               "threads": torch.get_num_threads(), "validation": get_validation_level()}
+
+    output = open(args.output, 'a') if args.output else None
+    for section in args.sections:
+        for record in SECTIONS[section](args, device):
+            line: str = json.dumps({**context, **record})
+            print(line)
+            if output:
+                output.write(line + "\n")
+                output.flush()
+    if output:
+        output.close()
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Throughput of the networks, losses, bounds and dataloader')
+    parser.add_argument("--sections", type=str, nargs='+', default=list(SECTIONS), choices=list(SECTIONS))
+    parser.add_argument("--networks", type=str, nargs='+', default=NETWORKS, choices=NETWORKS)
+    parser.add_argument("--n_class", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--workers", type=int, nargs='+', default=[0, 2, 4, 8],
+                        help="Worker counts to try for the dataloader")
+    parser.add_argument("--n_patients", type=int, default=4, help="Size of the synthetic dataset")
+    parser.add_argument("--n_slices", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--cpu", action='store_true')
+    parser.add_argument("--output", type=str, default='', help="JSON lines file, appended to")
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+    main(get_args())
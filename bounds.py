@@ -1,10 +1,22 @@
 #!/usr/bin/env python3.6
 
-from typing import Any, List
+import re
+import hashlib
+from typing import Any, List, Tuple
 import torch
 from torch import Tensor
 
 
+def bounds_hash(losses: List[Tuple], C: int, folders: str, on_fgt: bool, resize: int) -> str:
+    # Everything that changes the output of the bounds generators, but nothing else (loss weights, etc.)
+    # The folders spec carries the transforms along the folder names, whitespace aside
+    config = [(bounds_name, sorted(bounds_params.items()) if bounds_params else bounds_params, fn)
+              for _, _, bounds_name, bounds_params, fn, _ in losses]
+    spec: str = re.sub(r"\s+", "", folders)
+
+    return hashlib.sha1(repr((config, C, spec, bool(on_fgt), resize)).encode()).hexdigest()[:12]
+
+
 class ConstantBounds():
     def __init__(self, **kwargs):
         self.C: int = kwargs['C']
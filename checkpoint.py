@@ -0,0 +1,94 @@
+#!/usr/bin/env python3.6
+
+import os
+import random
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import torch
+import numpy as np
+from torch import nn
+
+from layers import convert_domain_bn
+
+
+def cpu_copy(obj: Any) -> Any:
+    # Detached host copies, so that training can go on while the snapshot is being written
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: cpu_copy(v) for (k, v) in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return obj
+
+
+def rng_states() -> Dict[str, Any]:
+    return {"torch": torch.get_rng_state(),
+            "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+            "numpy": np.random.get_state(),
+            "random": random.getstate()}
+
+
+def set_rng_states(states: Dict[str, Any]) -> None:
+    torch.set_rng_state(states["torch"])
+    if states["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+    np.random.set_state(states["numpy"])
+    random.setstate(states["random"])
+
+
+def snapshot(net: nn.Module, optimizer: Any, epoch: int, **extra) -> Dict[str, Any]:
+    return {"network": net.__class__.__name__,
+            "model": cpu_copy(net.state_dict()),
+            "optimizer": cpu_copy(optimizer.state_dict()) if optimizer else None,
+            "epoch": epoch,
+            "rng": rng_states(),
+            **extra}
+
+
+def save_checkpoint(state: Dict[str, Any], path: Path) -> None:
+    # Written next to the destination then renamed: a job killed mid-save never leaves a truncated checkpoint
+    tmp_path: Path = Path(f"{path}.tmp")
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter():
+    """
+    Saves the snapshots from a background thread, in submission order. Only the copy to the host (in snapshot)
+    happens in the training loop.
+    """
+    def __init__(self) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures: List[Future] = []
+
+    def save(self, state: Dict[str, Any], *paths: Path) -> None:
+        for path in paths:
+            self.futures.append(self.executor.submit(save_checkpoint, state, Path(path)))
+
+    def wait(self) -> None:
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self) -> None:
+        self.wait()
+        self.executor.shutdown()
+
+
+def load_model(path: str, network: str, n_class: int, map_location: Any = 'cpu', dtype: Any = None) -> nn.Module:
+    # Not only tensors: whole pickled modules, and the numpy/random states of the snapshots
+    obj = torch.load(path, map_location=map_location, weights_only=False)
+    if isinstance(obj, nn.Module):  # Whole pickled module, e.g. pretrained_source.pkl
+        net: nn.Module = obj
+    else:
+        net_class = getattr(__import__('networks'), obj.get("network", network))
+        net = net_class(1, n_class)
+        if obj.get("domain_bn"):
+            convert_domain_bn(net)
+        net.load_state_dict(obj["model"])
+
+    # Floating point parameters and buffers only, the BatchNorm counters stay integers
+    return net.to(dtype) if dtype is not None else net
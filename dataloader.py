@@ -16,10 +16,12 @@ from torch import Tensor
 from PIL import Image
 from torchvision import transforms
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.dataloader import default_collate
 from MySampler import Sampler
 import os
 from utils import id_, map_, class2one_hot
 from utils import simplex, sset, one_hot
+from bounds import bounds_hash
 
 F = Union[Path, BinaryIO]
 D = Union[Image.Image, np.ndarray, Tensor]
@@ -27,7 +29,8 @@ D = Union[Image.Image, np.ndarray, Tensor]
 
 def get_loaders(args, data_folder: str, subfolders:str,
                 batch_size: int, n_class: int,
-                debug: bool, in_memory: bool, dtype, shuffle:bool) -> Tuple[DataLoader, DataLoader]:
+                debug: bool, in_memory: bool, dtype, shuffle:bool,
+                fg_index: int = 1) -> Tuple[DataLoader, DataLoader]:
     png_transform = transforms.Compose([
         lambda img: np.array(img)[np.newaxis, ...],
         lambda nd: nd / 255,  # max <= 1
@@ -76,29 +79,41 @@ def get_loaders(args, data_folder: str, subfolders:str,
                           debug=debug,
                           C=n_class,
                           in_memory=in_memory,
+                          packed=args.packed,
                           bounds_generators=bounds_generators, bounds_on_fgt=args.bounds_on_fgt, bounds_on_train_stats=args.bounds_on_train_stats)
-    data_loader = partial(DataLoader,
-                          num_workers=10,
-                          pin_memory=True)
+    data_loader = partial(DataLoader, **loader_kwargs(args))
+
+    # Tables created beforehand by precompute_bounds.py, for the exact same bounds configuration
+    table_name: str = f"bounds_{bounds_hash(losses, n_class, subfolders, args.bounds_on_fgt, args.resize)}.npz"
+    use_table: bool = args.bounds_table and len(folders) > 2 and not args.bounds_on_train_stats
 
     # Prepare the datasets and dataloaders
     train_folders: List[Path] = [Path(data_folder, "train", f) for f in folders]
     # I assume all files have the same name inside their folder: makes things much easier
-    train_names: List[str] = map_(lambda p: str(p.name), train_folders[0].glob("*.png"))
-    train_names.sort()
+    train_names: List[str] = list_names(train_folders[0], args.packed)
     train_set = gen_dataset(train_names,
-                            train_folders)
-    train_loader = data_loader(train_set,
-                               batch_size=batch_size,
-                               shuffle=shuffle,
-                               drop_last=True)
+                            train_folders,
+                            bounds_table=Path(data_folder, "train", table_name) if use_table else None)
+    train_sampler: Sampler = get_train_sampler(args, train_set, batch_size, fg_index)
+    if train_sampler is not None:
+        train_loader = data_loader(train_set,
+                                   batch_sampler=train_sampler)
+    else:
+        train_loader = data_loader(train_set,
+                                   batch_size=batch_size,
+                                   shuffle=shuffle,
+                                   drop_last=True)
 
     val_folders: List[Path] = [Path(data_folder, "val", f) for f in folders]
-    val_names: List[str] = map_(lambda p: str(p.name), val_folders[0].glob("*.png"))
-    val_names.sort()
+    val_names: List[str] = list_names(val_folders[0], args.packed)
     val_set = gen_dataset(val_names,
-                          val_folders)
-    val_sampler = PatientSampler(val_set, args.grp_regex, shuffle=shuffle)
+                          val_folders,
+                          bounds_table=Path(data_folder, "val", table_name) if use_table else None)
+    val_sampler: Sampler
+    if args.val_batch_size:
+        val_sampler = PatientChunkSampler(val_set, args.grp_regex, args.val_batch_size)
+    else:
+        val_sampler = PatientSampler(val_set, args.grp_regex, shuffle=shuffle)
     # val_sampler = None
     val_loader = data_loader(val_set,
                              batch_sampler=val_sampler)
@@ -106,10 +121,108 @@ def get_loaders(args, data_folder: str, subfolders:str,
     return train_loader, val_loader
 
 
+def loader_kwargs(args) -> Dict[str, Any]:
+    kwargs: Dict[str, Any] = dict(num_workers=args.num_workers, pin_memory=bool(args.pin_memory))
+    if args.num_workers > 0:  # Both are rejected by the DataLoader without workers
+        # Persistent: the workers (and their opened files) survive from one epoch to the next
+        kwargs.update(persistent_workers=args.persistent_workers, prefetch_factor=args.prefetch_factor)
+    return kwargs
+
+
+def get_train_sampler(args, dataset: "SliceDataset", batch_size: int, fg_index: int = 1) -> Sampler:
+    # None for the default shuffled DataLoader. The others shuffle with --seed and the epoch, whatever `shuffle` is.
+    # fg_index: folder of the labels the foreground sampler may stratify on, negative if there is none (e.g. the
+    # target domain, whose ground truth cannot be used for training)
+    if args.train_sampler == "random" or (args.train_sampler == "foreground" and fg_index < 0):
+        return None
+
+    num_replicas, rank = 1, 0
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        num_replicas, rank = torch.distributed.get_world_size(), torch.distributed.get_rank()
+    shard = dict(seed=args.seed, num_replicas=num_replicas, rank=rank)
+
+    if args.train_sampler == "patient":
+        return PatientBatchSampler(dataset, args.grp_regex, batch_size, **shard)
+    if args.train_sampler == "foreground":
+        return ForegroundBatchSampler(dataset, batch_size, fg_index, **shard)
+    raise ValueError(args.train_sampler)
+
+
+def pack_paths(folder: Path) -> Tuple[Path, Path]:
+    # The pack of data/train/IP lives next to it: data/train/IP.npy and its index data/train/IP.txt
+    folder = Path(folder)
+    return Path(folder.parent, f"{folder.name}.npy"), Path(folder.parent, f"{folder.name}.txt")
+
+
+def load_pack_index(folder: Path) -> List[str]:
+    _, index_path = pack_paths(folder)
+    with open(index_path, 'r') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def load_pack(folder: Path) -> np.ndarray:
+    array_path, _ = pack_paths(folder)
+    # Memory mapped and read-only: the page cache is shared between all the loader workers
+    return np.load(array_path, mmap_mode='r')
+
+
+def load_bounds_table(path: Path, filenames: List[str]) -> List[np.ndarray]:
+    if not Path(path).exists():
+        raise FileNotFoundError(f"{path} does not exist, create it first with precompute_bounds.py")
+
+    with np.load(path) as data:
+        index: Dict[str, int] = {str(name): i for (i, name) in enumerate(data["names"])}
+        missing: List[str] = [f_n for f_n in filenames if f_n not in index]
+        assert not missing, (path, missing[:5])
+
+        rows: np.ndarray = np.array([index[f_n] for f_n in filenames], dtype=np.int64)
+        n_bounds: int = len([k for k in data.files if k.startswith("bounds_")])
+
+        # Reordered once here, so that the row of the table is the index of the dataset
+        return [np.ascontiguousarray(data[f"bounds_{i}"][rows]) for i in range(n_bounds)]
+
+
+def load_train_stats(path: str) -> Dict[str, Tuple[float, float]]:
+    # Either the folder of <num_slice>_stats.csv files, or the single file written by save_train_stats
+    if Path(path).is_file():
+        with np.load(path) as data:
+            return {str(k): (float(low), float(high)) for (k, (low, high)) in zip(data["slices"], data["bounds"])}
+
+    index: Dict[str, Tuple[float, float]] = {}
+    for stats_path in Path(path).glob("*_stats.csv"):
+        with open(stats_path) as f:
+            reader = csv.reader(f)
+            next(reader)  # skip header
+            dataf = [r for r in reader]
+            min_foreground = float(dataf[1][3])*0.8
+            max_foreground = float(dataf[2][3])*1.2
+
+        index[stats_path.name[:-len("_stats.csv")]] = (min_foreground, max_foreground)
+
+    return index
+
+
+def save_train_stats(index: Dict[str, Tuple[float, float]], path: str) -> None:
+    slices: List[str] = sorted(index)
+    np.savez(path, slices=np.array(slices), bounds=np.array([index[k] for k in slices], dtype=np.float64))
+
+
+def list_names(folder: Path, packed: bool = False) -> List[str]:
+    names: List[str]
+    if packed:
+        names = load_pack_index(folder)
+    else:
+        names = map_(lambda p: str(p.name), Path(folder).glob("*.png"))
+    names.sort()
+
+    return names
+
+
 class SliceDataset(Dataset):
     def __init__(self, filenames: List[str], folders: List[Path], are_hots: List[bool],
                  bounds_generators: List[Callable], transforms: List[Callable], debug=False,
-                 C=2, in_memory: bool = False, bounds_on_fgt=False, bounds_on_train_stats=False) -> None:
+                 C=2, in_memory: bool = False, packed: bool = False, bounds_table: Path = None,
+                 bounds_on_fgt=False, bounds_on_train_stats=False) -> None:
         self.folders: List[Path] = folders
         self.transforms: List[Callable[[D], Tensor]] = transforms
         assert len(self.transforms) == len(self.folders)
@@ -119,6 +232,7 @@ class SliceDataset(Dataset):
         self.debug = debug
         self.C: int = C  # Number of classes
         self.in_memory: bool = in_memory
+        self.packed: bool = packed
         self.bounds_generators: List[Callable] = bounds_generators
         self.bounds_on_fgt = bounds_on_fgt
         self.bounds_on_train_stats = bounds_on_train_stats
@@ -126,13 +240,31 @@ class SliceDataset(Dataset):
         if self.debug:
             self.filenames = self.filenames[:10]
 
-        assert self.check_files()  # Make sure all file exists
+        # Parsed once here instead of scanning the stats folder for every sample
+        self.train_stats: Dict[str, Tuple[float, float]] = {}
+        if self.bounds_on_train_stats:
+            self.train_stats = load_train_stats(self.bounds_on_train_stats)
+            print(f"Loaded the train stats of {len(self.train_stats)} slices from {self.bounds_on_train_stats}")
+
+        # (N, C, k, 2) float32 array for each bounds generator, in the same order as the filenames
+        self.bounds_table: List[np.ndarray] = []
+        if bounds_table:
+            self.bounds_table = load_bounds_table(bounds_table, self.filenames)
+            print(f"Using the bounds precomputed in {bounds_table}")
+
+        if self.packed:
+            # Row of each filename inside the pack of each folder. The memmaps themselves are opened lazily,
+            # so that each worker gets its own file handle instead of a pickled copy of the data
+            self.rows: List[List[int]] = SliceDataset.load_rows(self.folders, self.filenames)
+            self.packs: List[np.ndarray] = []
+        else:
+            assert self.check_files()  # Make sure all file exists
 
-        # Load things in memory if needed
-        self.files: List[List[F]] = SliceDataset.load_images(self.folders, self.filenames, self.in_memory)
-        assert len(self.files) == len(self.folders)
-        for files in self.files:
-            assert len(files) == len(self.filenames)
+            # Load things in memory if needed
+            self.files: List[List[F]] = SliceDataset.load_images(self.folders, self.filenames, self.in_memory)
+            assert len(self.files) == len(self.folders)
+            for files in self.files:
+                assert len(files) == len(self.filenames)
 
         print(f"Initialized {self.__class__.__name__} with {len(self.filenames)} images")
 
@@ -163,6 +295,18 @@ class SliceDataset(Dataset):
 
         return files
 
+    @staticmethod
+    def load_rows(folders: List[Path], filenames: List[str]) -> List[List[int]]:
+        rows: List[List[int]] = []
+        for folder in folders:
+            index: Dict[str, int] = {name: i for (i, name) in enumerate(load_pack_index(folder))}
+            missing: List[str] = [f_n for f_n in filenames if f_n not in index]
+            assert not missing, (folder, missing[:5])
+
+            rows.append([index[f_n] for f_n in filenames])
+
+        return rows
+
     def __len__(self):
         return len(self.filenames)
 
@@ -171,7 +315,11 @@ class SliceDataset(Dataset):
         path_name: Path = Path(filename)
         images: List[D]
 
-        if path_name.suffix == ".png":
+        if self.packed:
+            if not self.packs:
+                self.packs = [load_pack(folder) for folder in self.folders]
+            images = [pack[rows[index]] for (pack, rows) in zip(self.packs, self.rows)]
+        elif path_name.suffix == ".png":
             images = [Image.open(files[index]).convert('L') for files in self.files]
         elif path_name.suffix == ".npy":
             images = [np.load(files[index]) for files in self.files]
@@ -192,26 +340,19 @@ class SliceDataset(Dataset):
         img, gt = t_tensors[:2]
         #print(self.bounds_on_train_stats)
         if self.bounds_on_train_stats:
-            print('dd')
             num_slice = filename.split('_')[2].split('.')[0]
-            stats = os.listdir(self.bounds_on_train_stats)
-            grouping_regex = re.compile(num_slice + '_stats.csv')
-            matches = map_(grouping_regex.match, stats)
-            slice_bounds = [match.string for match in matches if type(match) != type(None)]
-            with open(self.bounds_on_train_stats+'/'+slice_bounds[0]) as f:
-                reader = csv.reader(f)
-                next(reader)  # skip header
-                dataf = [r for r in reader]
-                min_foreground = float(dataf[1][3])*0.8
-                max_foreground = float(dataf[2][3])*1.2
-
-                #print(float(dataf[0][3]))
-                min_background = 256*36 - max_foreground
-                max_background = 256*36 - min_foreground
+            min_foreground, max_foreground = self.train_stats[num_slice]
+
+            min_background = 256*36 - max_foreground
+            max_background = 256*36 - min_foreground
 
             boundsn = Tensor([[min_background,max_background],[min_foreground,max_foreground]])
             bounds = [torch.zeros((self.C, 1, 2), dtype=torch.float32), boundsn.unsqueeze(1)]
 
+        elif self.bounds_table:
+            bounds = [torch.from_numpy(table[index]) for table in self.bounds_table]
+            if self.bounds_on_fgt:
+                t_tensors.pop(2)
         elif self.bounds_on_fgt:
             fgt = t_tensors[2]
             bounds = [f(img, fgt, t, filename) for f, t in zip(self.bounds_generators, t_tensors[2:])]
@@ -224,6 +365,22 @@ class SliceDataset(Dataset):
         return [filename] + t_tensors + bounds
 
 
+def group_patients(filenames: List[str], grp_regex: str) -> Dict[str, List[int]]:
+    # Indices of the slices of each patient, patients in order of first appearance
+    grouping_regex: Pattern = re.compile(grp_regex)
+
+    stems: List[str] = [Path(filename).stem for filename in filenames]  # avoid matching the extension
+    matches: List[Match] = map_(grouping_regex.match, stems)
+    patients: List[str] = [match.group(0) for match in matches]
+
+    idx_map: Dict[str, List[int]] = {}
+    for i, patient in enumerate(patients):
+        idx_map.setdefault(patient, []).append(i)
+    assert sum(len(v) for v in idx_map.values()) == len(filenames)
+
+    return idx_map
+
+
 class PatientSampler(Sampler):
     def __init__(self, dataset: SliceDataset, grp_regex, shuffle=False) -> None:
         filenames: List[str] = dataset.filenames
@@ -238,24 +395,8 @@ class PatientSampler(Sampler):
         print(f"Grouping using {self.grp_regex} regex")
         # assert grp_regex == "(patient\d+_\d+)_\d+"
         # grouping_regex: Pattern = re.compile("grp_regex")
-        grouping_regex: Pattern = re.compile(self.grp_regex)
-
-        stems: List[str] = [Path(filename).stem for filename in filenames]  # avoid matching the extension
-        matches: List[Match] = map_(grouping_regex.match, stems)
-        patients: List[str] = [match.group(0) for match in matches]
-
-        unique_patients: List[str] = list(set(patients))
-        assert len(unique_patients) <= len(filenames)
-        print(f"Found {len(unique_patients)} unique patients out of {len(filenames)} images")
-
-        self.idx_map: Dict[str, List[int]] = dict(zip(unique_patients, repeat(None)))
-        for i, patient in enumerate(patients):
-            if not self.idx_map[patient]:
-                self.idx_map[patient] = []
-
-            self.idx_map[patient] += [i]
-        # print(self.idx_map)
-        assert sum(len(self.idx_map[k]) for k in unique_patients) == len(filenames)
+        self.idx_map: Dict[str, List[int]] = group_patients(filenames, self.grp_regex)
+        print(f"Found {len(self.idx_map)} unique patients out of {len(filenames)} images")
 
         print("Patient to slices mapping done")
 
@@ -266,3 +407,258 @@ class PatientSampler(Sampler):
         values = list(self.idx_map.values())
         shuffled = self.shuffle_fn(values)
         return iter(shuffled)
+
+
+def foreground_slices(dataset: SliceDataset, gt_index: int) -> np.ndarray:
+    # Whether each slice has any foreground in the labels of folder gt_index (class encoded, background is 0)
+    folder: Path = dataset.folders[gt_index]
+    if dataset.packed:
+        pack: np.ndarray = load_pack(folder)
+        return np.array([pack[row].any() for row in dataset.rows[gt_index]], dtype=bool)
+
+    def has_foreground(f: F, filename: str) -> bool:
+        if Path(filename).suffix == ".npy":
+            return bool(np.load(f).any())
+        return bool(np.array(Image.open(f)).any())
+
+    return np.array([has_foreground(f, f_n) for (f, f_n) in zip(dataset.files[gt_index], dataset.filenames)],
+                    dtype=bool)
+
+
+class ShardedBatchSampler(Sampler):
+    """
+    Base of the fixed-size batch samplers. The batches only depend on (seed, epoch, pass), so that every process
+    computes the same ones before taking its shard: one batch out of num_replicas, from rank. The pass counts the
+    iterations since the last set_epoch, when a domain is cycled (DomainPairLoader) each pass is reshuffled.
+    Each shard has the same number of batches, the extra ones are dropped.
+    """
+    def __init__(self, batch_size: int, seed: int = 0, num_replicas: int = 1, rank: int = 0) -> None:
+        assert batch_size >= 1, batch_size
+        assert 0 <= rank < num_replicas, (rank, num_replicas)
+        self.batch_size: int = batch_size
+        self.seed: int = seed
+        self.num_replicas: int = num_replicas
+        self.rank: int = rank
+        self.epoch: int = 0
+        self.passes: int = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+        self.passes = 0
+
+    def batches(self, rng: np.random.RandomState) -> List[List[int]]:
+        raise NotImplementedError
+
+    def n_batches(self) -> int:
+        raise NotImplementedError
+
+    def __len__(self):
+        return self.n_batches() // self.num_replicas
+
+    def __iter__(self):
+        rng = np.random.RandomState([self.seed, self.epoch, self.passes])
+        self.passes += 1
+        batches: List[List[int]] = self.batches(rng)
+        assert len(batches) == self.n_batches(), (len(batches), self.n_batches())
+
+        return iter(batches[self.rank:len(self) * self.num_replicas:self.num_replicas])
+
+
+class PatientBatchSampler(ShardedBatchSampler):
+    """
+    Fixed-size batches of consecutive slices of the same patient: the patients and the slices inside each patient
+    are shuffled, then concatenated and cut into batches. Only the batches at the boundary of two patients mix them.
+    """
+    def __init__(self, dataset: SliceDataset, grp_regex: str, batch_size: int, **kwargs) -> None:
+        super().__init__(batch_size, **kwargs)
+        self.idx_map: Dict[str, List[int]] = group_patients(dataset.filenames, grp_regex)
+        self.n_slices: int = len(dataset.filenames)
+
+        print(f"Initialized {self.__class__.__name__} with {len(self.idx_map)} patients, {self.n_batches()} batches")
+
+    def n_batches(self) -> int:
+        return self.n_slices // self.batch_size
+
+    def batches(self, rng: np.random.RandomState) -> List[List[int]]:
+        patients: List[List[int]] = list(self.idx_map.values())
+        order: np.ndarray = rng.permutation(len(patients))
+        stream: List[int] = [int(i) for p in order for i in rng.permutation(patients[p])]
+
+        return [stream[k * self.batch_size:(k + 1) * self.batch_size] for k in range(self.n_batches())]
+
+
+class ForegroundBatchSampler(ShardedBatchSampler):
+    """
+    Fixed-size batches stratified by foreground presence: every batch has the same share of slices with some
+    foreground as the whole dataset (or fg_fraction, when given), so that the size constraints always see both kinds.
+    The foreground is read from the labels of the folder gt_index.
+    """
+    def __init__(self, dataset: SliceDataset, batch_size: int, gt_index: int, fg_fraction: float = None,
+                 **kwargs) -> None:
+        super().__init__(batch_size, **kwargs)
+        assert 0 <= gt_index < len(dataset.folders), (gt_index, dataset.folders)
+        has_fg: np.ndarray = foreground_slices(dataset, gt_index)
+        self.fg: np.ndarray = np.flatnonzero(has_fg)
+        self.bg: np.ndarray = np.flatnonzero(~has_fg)
+        self.fg_fraction: float = len(self.fg) / len(has_fg) if fg_fraction is None else fg_fraction
+        assert 0 <= self.fg_fraction <= 1, self.fg_fraction
+
+        print(f"Initialized {self.__class__.__name__} with {len(self.fg)} foreground and {len(self.bg)} background "
+              f"slices, {100 * self.fg_fraction:.1f}% foreground per batch")
+
+    def n_fg(self, k: int) -> int:
+        # Foreground slices of the k-th batch, spread so that the first k batches get round(k * bs * fraction)
+        return (round((k + 1) * self.batch_size * self.fg_fraction) - round(k * self.batch_size * self.fg_fraction))
+
+    def n_batches(self) -> int:
+        # As many batches as the scarcest of the two pools allows
+        def fits(n: int) -> bool:
+            total_fg: int = round(n * self.batch_size * self.fg_fraction)  # Sum of n_fg over the first n batches
+            return total_fg <= len(self.fg) and n * self.batch_size - total_fg <= len(self.bg)
+
+        n: int = (len(self.fg) + len(self.bg)) // self.batch_size
+        while n > 0 and not fits(n):
+            n -= 1
+        return n
+
+    def batches(self, rng: np.random.RandomState) -> List[List[int]]:
+        fg: List[int] = rng.permutation(self.fg).tolist()
+        bg: List[int] = rng.permutation(self.bg).tolist()
+
+        res: List[List[int]] = []
+        for k in range(self.n_batches()):
+            n_fg: int = self.n_fg(k)
+            batch: List[int] = fg[:n_fg] + bg[:self.batch_size - n_fg]
+            fg, bg = fg[n_fg:], bg[self.batch_size - n_fg:]
+            res.append(rng.permutation(batch).tolist())
+
+        return res
+
+
+class PatientChunkSampler(Sampler):
+    """
+    Validation batches of batch_size slices, patient after patient: batches can span two patients (the 3d metrics
+    group the slices by filename), and only the last batch can be smaller. Nothing is shuffled nor dropped.
+    """
+    def __init__(self, dataset: SliceDataset, grp_regex: str, batch_size: int) -> None:
+        idx_map: Dict[str, List[int]] = group_patients(dataset.filenames, grp_regex)
+        self.stream: List[int] = [i for idx in idx_map.values() for i in idx]
+        self.batch_size: int = batch_size
+
+        print(f"Initialized {self.__class__.__name__} with {len(idx_map)} patients, batches of {batch_size} slices")
+
+    def __len__(self):
+        return (len(self.stream) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        return iter(self.stream[k:k + self.batch_size] for k in range(0, len(self.stream), self.batch_size))
+
+
+class PairDataset(Dataset):
+    """
+    Source and target datasets behind a single DataLoader, thus a single worker pool: items are indexed by
+    (domain, index), domain 0 being the source.
+    """
+    def __init__(self, source: Dataset, target: Dataset) -> None:
+        self.datasets: List[Dataset] = [source, target]
+
+    def __len__(self):
+        return sum(len(d) for d in self.datasets)
+
+    def __getitem__(self, key: Tuple[int, int]) -> Tuple[int, List[Any]]:
+        domain, index = key
+        return domain, self.datasets[domain][index]
+
+
+class Cycle():
+    # Endless stream over a DataLoader or a batch sampler: iterated again, thus reshuffled, once exhausted
+    def __init__(self, iterable: Any) -> None:
+        assert len(iterable) > 0, "Cannot cycle over an empty domain"
+        self.iterable: Any = iterable
+        self.iterator: Any = None
+
+    def reset(self) -> None:
+        self.iterator = None
+
+    def __next__(self) -> Any:
+        if self.iterator is None:
+            self.iterator = iter(self.iterable)
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            self.iterator = iter(self.iterable)
+            return next(self.iterator)
+
+
+class PairBatchSampler(Sampler):
+    # Index level counterpart of DomainPairLoader, for the shared worker pool: one batch of each domain per step
+    def __init__(self, source: Any, target: Any, length: int, continuous: bool) -> None:
+        self.streams: List[Cycle] = [Cycle(source), Cycle(target)]
+        self.length: int = length
+        self.continuous: bool = continuous
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        if not self.continuous:
+            for stream in self.streams:
+                stream.reset()
+        for _ in range(self.length):
+            source_batch, target_batch = map(next, self.streams)
+            yield [(0, i) for i in source_batch] + [(1, j) for j in target_batch]
+
+
+def collate_pairs(batch: List[Tuple[int, List[Any]]]) -> Tuple[List[Any], List[Any]]:
+    # The two domains can have different batch sizes (validation patients), so they are collated separately
+    source: List[Any] = [item for (domain, item) in batch if domain == 0]
+    target: List[Any] = [item for (domain, item) in batch if domain == 1]
+
+    return default_collate(source), default_collate(target)
+
+
+class DomainPairLoader():
+    """
+    Streams (source batch, target batch) pairs. Each domain is an endless stream of its batches, iterated again
+    (thus reshuffled) as soon as it is exhausted, independently of the other domain: the shorter one is cycled.
+    An epoch is `length` pairs, the length of the longest domain by default.
+
+    continuous: the streams carry over from one epoch to the next, so that nothing already loaded is thrown away.
+    The position in the streams is not part of the checkpoints though, so a --resume'd run sees other batches.
+    Otherwise both restart at each epoch, from the samplers reshuffled by set_epoch: the batches of an epoch then
+    only depend on the seed and the epoch, and for the validation each target slice is seen exactly once.
+
+    The DataLoaders themselves are only iterated again once exhausted, which reuses their workers with
+    --persistent_workers. With shared=True, both domains go through a single DataLoader (and pool of workers),
+    the two given loaders only provide their datasets and batch samplers, and are never iterated.
+    """
+    def __init__(self, args, source: DataLoader, target: DataLoader, length: int = 0, continuous: bool = True,
+                 shared: bool = False) -> None:
+        self.length: int = length or max(len(source), len(target))
+        self.continuous: bool = continuous
+
+        self.loader: DataLoader = None
+        if shared:
+            self.loader = DataLoader(PairDataset(source.dataset, target.dataset),
+                                     batch_sampler=PairBatchSampler(source.batch_sampler, target.batch_sampler,
+                                                                    self.length, continuous),
+                                     collate_fn=collate_pairs,
+                                     **loader_kwargs(args))
+        self.streams: List[Cycle] = [Cycle(source), Cycle(target)]
+
+        print(f"Initialized {self.__class__.__name__} with {len(source)} source and {len(target)} target batches, "
+              f"{self.length} pairs per epoch")
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        if self.loader is not None:
+            yield from self.loader
+            return
+
+        if not self.continuous:
+            for stream in self.streams:
+                stream.reset()
+        for _ in range(self.length):
+            yield next(self.streams[0]), next(self.streams[1])
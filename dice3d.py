@@ -2,11 +2,12 @@
 
 import re
 from pathlib import Path
-from typing import Any, Callable, BinaryIO, Dict, List, Match, Pattern, Tuple, Union
+from typing import Any, Callable, BinaryIO, Dict, List, Match, Pattern, Set, Tuple, Union
 import torch
+from torch import Tensor
 import numpy as np
 from utils import id_, map_, class2one_hot, resize_im
-from utils import simplex, sset, one_hot, dice_batch
+from utils import simplex, sset, one_hot, dice_batch, write_image
 from argparse import Namespace, ArgumentParser
 import pandas as pd
 import imageio
@@ -66,6 +67,111 @@ def dice3d(base_folder, folder, subfoldername, grp_regex, gt_folder) -> List:
     return np.mean(batch_dice)
 
 
+class PatientDiceAccumulator():
+    """
+    Running intersection and cardinalities per patient, updated at each batch, to get the 3d dice at the end of an
+    epoch without keeping the per slice predictions. The sums are O(patients x C) on the device; the names of the
+    slices already counted are kept as well, so the host memory is still O(slices), a few bytes each.
+    """
+    def __init__(self, grp_regex: str, C: int, device: Any, smooth: float = 1e-8) -> None:
+        self.grouping_regex: Pattern = re.compile(grp_regex)
+        self.C: int = C
+        self.device = device
+        self.smooth: float = smooth
+
+        self.patients: Dict[str, int] = {}
+        # When the shorter loader is cycled, its slices come back in the same epoch: count them only once
+        self.seen: Set[str] = set()
+
+        self.inter_card: Tensor = torch.zeros((0, C), dtype=torch.float64, device=device)
+        self.card_gt: Tensor = torch.zeros((0, C), dtype=torch.float64, device=device)
+        self.card_pred: Tensor = torch.zeros((0, C), dtype=torch.float64, device=device)
+
+    def patient_id(self, filename: str) -> int:
+        patient: str = self.grouping_regex.match(Path(filename).stem).group(0)  # avoid matching the extension
+        if patient not in self.patients:
+            self.patients[patient] = len(self.patients)
+
+        return self.patients[patient]
+
+    def grow(self, n: int) -> None:
+        if n <= len(self.inter_card):
+            return
+
+        new_n: int = max(n, 2 * len(self.inter_card))
+        pad = lambda t: torch.cat([t, t.new_zeros((new_n - len(t), self.C))], dim=0)
+        self.inter_card, self.card_gt, self.card_pred = map_(pad, [self.inter_card, self.card_gt, self.card_pred])
+
+    def update(self, filenames: List[str], inter_card: Tensor, card_gt: Tensor, card_pred: Tensor) -> None:
+        assert inter_card.shape == card_gt.shape == card_pred.shape == (len(filenames), self.C)
+
+        keep: List[int] = [i for (i, f) in enumerate(filenames) if f not in self.seen]
+        if not keep:
+            return
+        kept_filenames: List[str] = [filenames[i] for i in keep]
+        self.seen.update(kept_filenames)
+
+        ids: List[int] = map_(self.patient_id, kept_filenames)
+        self.grow(len(self.patients))
+
+        rows: Tensor = torch.tensor(keep, device=inter_card.device)
+        idx: Tensor = torch.tensor(ids, device=self.device)
+        for acc, values in zip([self.inter_card, self.card_gt, self.card_pred], [inter_card, card_gt, card_pred]):
+            acc.index_add_(0, idx, values.index_select(0, rows).to(self.device, torch.float64))
+
+    def dices(self) -> Tensor:
+        n: int = len(self.patients)
+        return (2 * self.inter_card[:n] + self.smooth) / (self.card_gt[:n] + self.card_pred[:n] + self.smooth)
+
+    def compute(self, metric_axis: List[int]) -> Tuple[float, float]:
+        # 3d dice of each patient, averaged over the metric classes, then mean and sd over the patients
+        if not self.patients:
+            return 0., 0.
+        per_patient: Tensor = self.dices()[:, metric_axis].mean(dim=1)
+
+        return per_patient.mean().item(), per_patient.std(unbiased=False).item()
+
+
+class PatientVolumes():
+    """
+    Predictions (and ground truth) of an epoch kept in memory as uint8 class maps, grouped per patient, instead of
+    being written as pngs only to be read back. Exported to pngs only when needed (best or last epoch).
+    """
+    def __init__(self, grp_regex: str) -> None:
+        self.grp_regex: str = grp_regex
+        self.grouping_regex: Pattern = re.compile(grp_regex)
+        self.slices: Dict[str, Dict[str, Tuple[np.ndarray, np.ndarray]]] = {}
+
+    def add(self, segs: Tensor, gts: Tensor, names: List[str]) -> None:
+        assert segs.shape == gts.shape and len(segs) == len(names), (segs.shape, gts.shape, len(names))
+        # One transfer per batch, in the smallest type
+        n_segs: np.ndarray = segs.type(torch.uint8).cpu().numpy()
+        n_gts: np.ndarray = gts.type(torch.uint8).cpu().numpy()
+
+        for seg, gt, name in zip(n_segs, n_gts, names):
+            patient: str = self.grouping_regex.match(Path(name).stem).group(0)
+            self.slices.setdefault(patient, {})[name] = (seg, gt)
+
+    def __len__(self) -> int:
+        return len(self.slices)
+
+    def volumes(self) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        # (w, h, n) volumes as in dice3d, slices placed by their index: the names are not zero padded (Subj_1_10)
+        index: Callable[[str], int] = lambda name: int(re.split(self.grp_regex, Path(name).stem)[1])
+        res: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        for patient, slices in self.slices.items():
+            names: List[str] = sorted(slices, key=index)
+            res[patient] = (np.stack([slices[n][0] for n in names], axis=-1),
+                            np.stack([slices[n][1] for n in names], axis=-1))
+
+        return res
+
+    def export(self, folder: Path, remap: bool = True, fmt: str = "png", compress_level: int = 6) -> None:
+        for slices in self.slices.values():
+            for name, (seg, _) in slices.items():
+                write_image(seg, Path(folder, name), remap, fmt, compress_level)
+
+
 def get_args() -> Namespace:
     parser = ArgumentParser(description='Hyperparams')
     parser.add_argument('--base_folder', type=str, required=True)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3.6
+
+import argparse
+from pathlib import Path
+from typing import Dict
+
+import torch
+import numpy as np
+from torch import nn, Tensor
+
+from checkpoint import load_model
+from fusion import fuse_model
+from layers import has_domain_bn
+
+
+def to_torchscript(net: nn.Module, example: Tensor, mode: str) -> torch.jit.ScriptModule:
+    assert mode != "script" or not has_domain_bn(net), \
+        "--jit script does not support the DomainBatchNorm2d of --domain_bn networks, use --jit trace"
+    with torch.no_grad():
+        scripted = torch.jit.trace(net, example) if mode == "trace" else torch.jit.script(net)
+        # Folds BatchNorm into the convolutions and inlines the constants
+        return torch.jit.freeze(scripted)
+
+
+def to_onnx(net: nn.Module, example: Tensor, path: Path, opset: int) -> None:
+    with torch.no_grad():
+        torch.onnx.export(net, example, str(path), opset_version=opset,
+                          input_names=["image"], output_names=["logits"],
+                          dynamic_axes={"image": {0: "batch"}, "logits": {0: "batch"}})
+
+
+def run_onnx(path: Path, example: Tensor) -> np.ndarray:
+    import onnxruntime  # Optional dependency, only for the parity check of the onnx graph
+
+    session = onnxruntime.InferenceSession(str(path), providers=["CPUExecutionProvider"])
+    return session.run(None, {"image": example.numpy()})[0]
+
+
+def check_parity(reference: Tensor, outputs: Dict[str, Tensor], atol: float) -> None:
+    # Max absolute difference of the logits, and agreement of the predicted classes
+    for name, output in outputs.items():
+        assert output.shape == reference.shape, (name, output.shape, reference.shape)
+        diff: float = (output - reference).abs().max().item()
+        agreement: float = (output.argmax(dim=1) == reference.argmax(dim=1)).float().mean().item()
+        print(f"{name:>12}: max abs diff {diff:.2e}, same class for {100 * agreement:.3f}% of the pixels")
+        assert diff <= atol, f"{name} differs from the eager model by {diff} > {atol}"
+
+
+def main(args: argparse.Namespace) -> None:
+    torch.manual_seed(0)
+    if args.checkpoint:
+        net: nn.Module = load_model(args.checkpoint, args.network, args.n_class, 'cpu')
+    else:  # Random weights, to check the export itself. No apply: fcn8s would download the vgg weights
+        net = getattr(__import__('networks'), args.network)(1, args.n_class)
+    net.eval()
+
+    if args.fuse:
+        net = fuse_model(net)
+
+    example: Tensor = torch.rand((args.batch_size, 1, *args.shape))
+    with torch.no_grad():
+        reference: Tensor = net(example)
+
+    save_folder: Path = Path(args.save_folder)
+    save_folder.mkdir(parents=True, exist_ok=True)
+    stem: str = args.name or (Path(args.checkpoint).stem if args.checkpoint else args.network)
+
+    outputs: Dict[str, Tensor] = {}
+    if args.format in ["torchscript", "all"]:
+        scripted = to_torchscript(net, example, args.jit)
+        ts_path: Path = Path(save_folder, f"{stem}_{args.jit}.pt")
+        scripted.save(str(ts_path))
+        print(f"Saved {ts_path}")
+
+        with torch.no_grad():
+            outputs[args.jit] = torch.jit.load(str(ts_path))(example)
+
+    if args.format in ["onnx", "all"]:
+        onnx_path: Path = Path(save_folder, f"{stem}.onnx")
+        to_onnx(net, example, onnx_path, args.opset)
+        print(f"Saved {onnx_path}")
+
+        try:
+            outputs["onnx"] = torch.from_numpy(run_onnx(onnx_path, example))
+        except ImportError:
+            print("onnxruntime is not installed, skipping the parity check of the onnx graph")
+
+    check_parity(reference, outputs, args.atol)
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Export a network to TorchScript and ONNX, and check them')
+    parser.add_argument('--checkpoint', type=str, default='',
+                        help="state_dict checkpoint or whole pickled network. Random weights if empty")
+    parser.add_argument("--network", type=str, default="ENet", choices=["ENet", "UNet", "fcn8s"])
+    parser.add_argument("--n_class", type=int, default=2)
+    parser.add_argument('--save_folder', type=str, required=True)
+    parser.add_argument('--name', type=str, default='')
+    parser.add_argument("--format", type=str, default="all", choices=["torchscript", "onnx", "all"])
+    parser.add_argument("--jit", type=str, default="trace", choices=["trace", "script"])
+    parser.add_argument("--fuse", action='store_true', help="Fold BatchNorm and remove dropout before exporting")
+    parser.add_argument("--shape", type=int, nargs=2, default=[256, 256])
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--opset", type=int, default=11)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    args = parser.parse_args()
+    print(args)
+
+    return args
+
+
+if __name__ == "__main__":
+    main(get_args())
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3.6
+
+import re
+import copy
+import argparse
+from typing import List, Optional, Tuple
+
+import torch
+from torch import nn, Tensor
+
+from checkpoint import load_model
+
+
+Conv = (nn.Conv2d, nn.ConvTranspose2d)
+Dropout = (nn.Dropout, nn.Dropout2d, nn.Dropout3d, nn.AlphaDropout)
+
+
+def fuse_conv_bn(conv: nn.Module, bn: nn.BatchNorm2d) -> Optional[nn.Module]:
+    """
+    Returns a copy of the convolution with the (eval mode) BatchNorm folded in its weight and bias:
+    bn(conv(x)) = gamma * (W * x + b - mean) / std + beta = (W * gamma / std) * x + (b - mean) * gamma / std + beta
+    None if it cannot be folded.
+    """
+    if bn.running_mean is None or (isinstance(conv, nn.ConvTranspose2d) and conv.groups != 1):
+        return None
+
+    with torch.no_grad():
+        scale: Tensor = bn.running_var.add(bn.eps).rsqrt()
+        if bn.affine:
+            scale = scale * bn.weight
+        shift: Tensor = bn.bias if bn.affine else torch.zeros_like(scale)
+        bias: Tensor = conv.bias if conv.bias is not None else torch.zeros_like(scale)
+
+        fused = copy.deepcopy(conv)
+        # Output channels are the first dim of Conv2d weights, the second of ConvTranspose2d ones
+        shape: List[int] = [-1, 1, 1, 1] if isinstance(conv, nn.Conv2d) else [1, -1, 1, 1]
+        fused.weight = nn.Parameter(conv.weight * scale.view(shape))
+        fused.bias = nn.Parameter((bias - bn.running_mean) * scale + shift)
+
+    return fused
+
+
+def fuse_children(module: nn.Module) -> int:
+    fused: int = 0
+
+    pairs: List[Tuple[str, str]]
+    if isinstance(module, nn.Sequential):
+        # conv_block*, convBatch, conv_decod_block, ...: the BatchNorm directly follows the convolution
+        names: List[str] = list(module._modules.keys())
+        pairs = list(zip(names[:-1], names[1:]))
+    else:
+        # ENet bottlenecks: c = self.convN(x); b = self.bnN(c)
+        pairs = [(name, "bn" + m.group(1)) for name in module._modules
+                 for m in [re.fullmatch(r"conv(\d+)", name)] if m]
+
+    for conv_name, bn_name in pairs:
+        conv: Optional[nn.Module] = module._modules.get(conv_name)
+        bn: Optional[nn.Module] = module._modules.get(bn_name)
+        if not (isinstance(conv, Conv) and type(bn) == nn.BatchNorm2d):
+            continue
+
+        new_conv: Optional[nn.Module] = fuse_conv_bn(conv, bn)
+        if new_conv is not None:
+            module._modules[conv_name] = new_conv
+            module._modules[bn_name] = nn.Identity()
+            fused += 1
+
+    for name, child in module._modules.items():
+        if isinstance(child, Dropout):
+            module._modules[name] = nn.Identity()
+        elif child is not None:
+            fused += fuse_children(child)
+
+    return fused
+
+
+def fuse_model(net: nn.Module) -> nn.Module:
+    """
+    Inference only copy of the network, with the BatchNorm folded into the preceding convolutions and the dropout
+    layers replaced by identities. The PReLU cannot be folded, and stay as is. The domain specific BatchNorm
+    (--domain_bn) are not folded either, as they depend on the selected domain.
+    """
+    fused_net: nn.Module = copy.deepcopy(net).eval()
+    n: int = fuse_children(fused_net)
+    print(f"Folded {n} BatchNorm into their convolution")
+
+    return fused_net
+
+
+def check_equivalence(net: nn.Module, fused_net: nn.Module, shape: Tuple[int, int],
+                      batch_size: int = 2, atol: float = 1e-4) -> float:
+    example: Tensor = torch.rand((batch_size, 1, *shape))
+    with torch.no_grad():
+        reference: Tensor = net.eval()(example)
+        output: Tensor = fused_net(example)
+
+    diff: float = (reference - output).abs().max().item()
+    print(f"Max abs diff of the logits: {diff:.2e}")
+    assert diff <= atol, f"The fused network differs by {diff} > {atol}"
+
+    return diff
+
+
+def count_layers(net: nn.Module) -> int:
+    return sum(1 for m in net.modules() if not list(m.children()) and not isinstance(m, nn.Identity))
+
+
+def main(args: argparse.Namespace) -> None:
+    torch.manual_seed(0)
+    if args.checkpoint:
+        net: nn.Module = load_model(args.checkpoint, args.network, args.n_class, 'cpu')
+    else:  # Random weights and statistics, to check the fusion itself
+        net = getattr(__import__('networks'), args.network)(1, args.n_class)
+        for m in net.modules():
+            if type(m) == nn.BatchNorm2d:
+                m.running_mean.uniform_(-1, 1)
+                m.running_var.uniform_(0.5, 2)
+    net.eval()
+
+    fused_net: nn.Module = fuse_model(net)
+    print(f"{count_layers(net)} layers before, {count_layers(fused_net)} after")
+    check_equivalence(net, fused_net, args.shape, atol=args.atol)
+
+    if args.save:
+        # Whole network, since the fused one does not match the state_dict of the original class anymore
+        torch.save(fused_net, args.save)
+        print(f"Saved {args.save}")
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Fold BatchNorm into the convolutions, and check the result')
+    parser.add_argument('--checkpoint', type=str, default='', help="Random weights if empty")
+    parser.add_argument("--network", type=str, default="ENet", choices=["ENet", "UNet", "fcn8s"])
+    parser.add_argument("--n_class", type=int, default=2)
+    parser.add_argument("--shape", type=int, nargs=2, default=[256, 256])
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument('--save', type=str, default='')
+    args = parser.parse_args()
+    print(args)
+
+    return args
+
+
+if __name__ == "__main__":
+    main(get_args())
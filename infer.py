@@ -0,0 +1,175 @@
+#!/usr/bin/env python3.6
+
+import re
+import argparse
+import zipfile
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import torch
+import numpy as np
+from torch import nn, Tensor
+from PIL import Image
+
+from checkpoint import load_model
+from fusion import fuse_model
+from layers import has_domain_bn
+from dataloader import group_patients, list_names
+from utils import resize, write_image, tqdm_
+
+
+def read_slice(path: Path) -> np.ndarray:
+    # Same as the png_transform of the dataloader
+    return np.array(Image.open(path).convert('L'), dtype=np.float32) / 255
+
+
+def estimate_slice_bytes(net: nn.Module, shape: Tuple[int, int], device: torch.device) -> int:
+    # Sum of the outputs of all the leaf modules for a single slice: an upper bound of the memory needed per slice,
+    # since in inference mode most intermediate activations are freed as soon as they are consumed
+    total: List[int] = [0]
+
+    def hook(module, input, output):
+        for o in (output if isinstance(output, tuple) else (output,)):
+            if isinstance(o, Tensor):
+                total[0] += o.numel() * o.element_size()
+
+    handles = [m.register_forward_hook(hook) for m in net.modules() if not list(m.children())]
+    with torch.inference_mode():
+        net(torch.zeros((1, 1, *shape), device=device))
+    for handle in handles:
+        handle.remove()
+
+    return total[0]
+
+
+def predict(net: nn.Module, patients: Dict[str, List[Path]], batch_size: int, device: torch.device,
+            new_w: int = 0) -> Iterator[Tuple[str, List[Path], np.ndarray]]:
+    """
+    Streams the slices of consecutive patients through fixed size batches, which can span several patients, and
+    yields each patient as soon as all its slices are predicted: (patient, slice paths, (n, w, h) uint8 classes).
+    """
+    pending: Dict[str, List[np.ndarray]] = {}
+    batch: List[Tuple[str, int, np.ndarray]] = []
+
+    def run_batch() -> Iterator[Tuple[str, List[Path], np.ndarray]]:
+        images: Tensor = torch.from_numpy(np.stack([img for (_, _, img) in batch]))[:, None, ...].to(device)
+        with torch.inference_mode():
+            logits: Tensor = net(images)
+            if new_w > 0:
+                logits = resize(logits, new_w)
+            classes: np.ndarray = logits.argmax(dim=1).type(torch.uint8).cpu().numpy()
+
+        for (patient, i, _), seg in zip(batch, classes):
+            pending[patient][i] = seg
+        batch.clear()
+
+        for patient in [p for (p, segs) in pending.items() if all(s is not None for s in segs)]:
+            yield patient, patients[patient], np.stack(pending.pop(patient), axis=0)
+
+    for patient, paths in patients.items():
+        pending[patient] = [None] * len(paths)
+        for i, path in enumerate(paths):
+            batch.append((patient, i, read_slice(path)))
+            if len(batch) == batch_size:
+                yield from run_batch()
+    if batch:
+        yield from run_batch()
+
+
+def is_torchscript(path: str) -> bool:
+    # Files saved by torch.jit (such as the ones of export.py) are zip archives with a code/ folder
+    try:
+        with zipfile.ZipFile(path) as archive:
+            return any("/code/" in name for name in archive.namelist())
+    except zipfile.BadZipFile:
+        return False
+
+
+def load_network(args: argparse.Namespace, device: torch.device) -> nn.Module:
+    net: nn.Module
+    if is_torchscript(args.checkpoint):
+        net = torch.jit.load(args.checkpoint, map_location=device)
+    else:
+        net = load_model(args.checkpoint, args.network, args.n_class, 'cpu').to(device)
+    net.eval()
+
+    return net
+
+
+def jit_network(net: nn.Module, mode: str, example: Tensor) -> nn.Module:
+    if mode == "none" or isinstance(net, torch.jit.ScriptModule):
+        return net
+    assert mode != "script" or not has_domain_bn(net), \
+        "--jit script does not support the DomainBatchNorm2d of --domain_bn networks, use --jit trace"
+
+    # Traced (or scripted) then frozen: BatchNorm is folded into the convolutions, no more python overhead
+    with torch.inference_mode(False), torch.no_grad():
+        scripted = torch.jit.trace(net, example) if mode == "trace" else torch.jit.script(net)
+        return torch.jit.freeze(scripted)
+
+
+def main(args: argparse.Namespace) -> None:
+    torch.set_num_threads(args.threads)
+    device = torch.device("cpu") if args.cpu or not torch.cuda.is_available() else torch.device("cuda")
+
+    names: List[str] = list_names(Path(args.data_folder))
+    assert names, args.data_folder
+    # Slices of each patient by index, as the names are not zero padded (Subj_1_10 sorts before Subj_1_2)
+    index: Callable[[Path], int] = lambda path: int(re.split(args.grp_regex, path.stem)[1])
+    patients: Dict[str, List[Path]] = {patient: sorted((Path(args.data_folder, names[i]) for i in idx), key=index)
+                                       for (patient, idx) in group_patients(names, args.grp_regex).items()}
+    shape: Tuple[int, int] = read_slice(Path(args.data_folder, names[0])).shape
+    print(f"Found {len(patients)} patients and {len(names)} slices of shape {shape}")
+
+    net: nn.Module = load_network(args, device)
+    if args.fuse and not isinstance(net, torch.jit.ScriptModule):
+        net = fuse_model(net)
+
+    batch_size: int = args.batch_size
+    if not batch_size:
+        # The hooks need the eager modules
+        assert not isinstance(net, torch.jit.ScriptModule), "--batch_size is required with a TorchScript checkpoint"
+        slice_bytes: int = estimate_slice_bytes(net, shape, device)
+        batch_size = max(1, int(args.memory_budget * 2**20) // slice_bytes)
+        print(f"{slice_bytes / 2**20:.1f}MB per slice, batches of {batch_size} slices "
+              f"for a budget of {args.memory_budget}MB")
+    net = jit_network(net, args.jit, torch.zeros((1, 1, *shape), device=device))
+
+    save_folder: Path = Path(args.save_folder)
+    save_folder.mkdir(parents=True, exist_ok=True)
+    for patient, paths, segs in tqdm_(predict(net, patients, batch_size, device, args.resize),
+                                      total=len(patients), desc=">> Inference"):
+        if args.output == "volume":
+            np.save(Path(save_folder, f"{patient}.npy"), segs)
+        else:
+            for path, seg in zip(paths, segs):
+                write_image(seg, Path(save_folder, path.name), True, "png", args.png_compression)
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Segment a folder of slices, patient per patient')
+    parser.add_argument('--data_folder', type=str, required=True, help="Folder of png slices")
+    parser.add_argument('--save_folder', type=str, required=True)
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help="state_dict checkpoint (best_3d.pth, ...), whole pickled network or TorchScript export")
+    parser.add_argument("--network", type=str, default="ENet", help="Used only if the checkpoint does not tell")
+    parser.add_argument("--n_class", type=int, default=2)
+    parser.add_argument("--grp_regex", type=str, required=True)
+    parser.add_argument("--resize", type=int, default=0)
+    parser.add_argument("--output", type=str, default="png", choices=["png", "volume"],
+                        help="png slices, or a (n, w, h) uint8 .npy volume per patient")
+    parser.add_argument("--png_compression", type=int, default=1, choices=range(10))
+    parser.add_argument("--batch_size", type=int, default=0, help="Slices per batch, 0 to use --memory_budget")
+    parser.add_argument("--memory_budget", type=float, default=512, help="MB of activations per batch")
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--jit", type=str, default="none", choices=["none", "trace", "script"])
+    parser.add_argument("--fuse", action='store_true', help="Fold BatchNorm into the convolutions, remove dropout")
+    parser.add_argument("--cpu", action='store_true')
+    args = parser.parse_args()
+    print(args)
+
+    return args
+
+
+if __name__ == "__main__":
+    main(get_args())
@@ -1,5 +1,8 @@
 #!/usr/bin/env python3.6
 
+import copy
+
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -135,4 +138,47 @@ class residualConv(nn.Module):
 
     def forward(self, input):
         out = self.convs(input)
-        return F.leaky_relu(out + self.res(input), 0.2)
\ No newline at end of file
+        return F.leaky_relu(out + self.res(input), 0.2)
+
+# Domain specific batch normalization
+class DomainBatchNorm2d(nn.Module):
+    """
+    One BatchNorm2d per domain, 0 for the target and 1 for the source. When both domains go through the network as
+    a single concatenated batch, split is the number of target samples at its beginning.
+    """
+    def __init__(self, bn: nn.BatchNorm2d, n_domains: int = 2):
+        super().__init__()
+
+        self.bns = nn.ModuleList([copy.deepcopy(bn) for _ in range(n_domains)])
+        self.domain = 0
+        self.split = 0
+
+    def forward(self, input):
+        if self.split:
+            return torch.cat((self.bns[0](input[:self.split]), self.bns[1](input[self.split:])), dim=0)
+        return self.bns[self.domain](input)
+
+
+def convert_domain_bn(module, n_domains=2):
+    # Replaces in place every BatchNorm2d (convBatch, conv_block*, ENet bottlenecks, ...), keeping its statistics.
+    # Already converted networks (e.g. loaded from a --domain_bn checkpoint) are left as is
+    if isinstance(module, DomainBatchNorm2d):
+        return module
+    for name, child in module.named_children():
+        if isinstance(child, nn.BatchNorm2d):
+            setattr(module, name, DomainBatchNorm2d(child, n_domains))
+        else:
+            convert_domain_bn(child, n_domains)
+    return module
+
+
+def has_domain_bn(module):
+    # Their python side domain selection cannot be compiled by torch.jit.script, only traced
+    return any(isinstance(m, DomainBatchNorm2d) for m in module.modules())
+
+
+def set_domain(module, domain=0, split=0):
+    for m in module.modules():
+        if isinstance(m, DomainBatchNorm2d):
+            m.domain = domain
+            m.split = split
@@ -30,11 +30,46 @@ class CrossEntropy():
         return loss
 
 
+class SoftSizePenalty(torch.autograd.Function):
+    """
+    NaivePenalty for fn=soft_size, in a single pass and with an analytic backward: instead of the intermediate
+    masks and (b, C, w, h) slices, only the (b, C) gradient coefficients are kept between forward and backward.
+    """
+    @staticmethod
+    def forward(ctx, probs: Tensor, idc: List[int], lower_b: Tensor, upper_b: Tensor) -> Tensor:
+        b, c, w, h = probs.shape  # type: Tuple[int, int, int, int]
+
+        value: Tensor = probs.sum(dim=(2, 3))[:, idc, None]  # Sum first, so the slicing is on (b, c) only
+        too_big: Tensor = (value - upper_b).clamp(min=0)
+        too_small: Tensor = (lower_b - value).clamp(min=0)
+        norm: float = w * h * too_big.numel()  # Division by the size, then mean over b, C and k
+
+        # d(loss)/d(value), summed over k since the value is broadcasted over the bounds
+        ctx.coef = (2 / norm) * (too_big - too_small).sum(dim=2)
+        ctx.idc = idc
+        ctx.shape = probs.shape
+
+        return (too_big ** 2 + too_small ** 2).sum() / norm
+
+    @staticmethod
+    def backward(ctx, grad_output: Tensor):
+        b, c, w, h = ctx.shape
+        coef: Tensor = ctx.coef * grad_output
+
+        grad: Tensor = coef.new_zeros((b, c))
+        grad.index_add_(1, torch.tensor(ctx.idc, device=coef.device), coef)
+
+        # The soft size is a plain sum: same gradient for every pixel, expand does not allocate
+        return grad[..., None, None].expand(b, c, w, h), None, None, None
+
+
 class NaivePenalty():
     def __init__(self, **kwargs):
         self.idc: List[int] = kwargs["idc"]
         self.C = len(self.idc)
         self.dtype = kwargs["dtype"]
+        # Fused path only for soft_size, other fns go through the generic implementation
+        self.fused: bool = kwargs.get("fused", True) and kwargs['fn'] == "soft_size"
         print(f"Initialized {self.__class__.__name__} with {kwargs}")
 
         self.__fn__ = getattr(__import__('utils'), kwargs['fn'])
@@ -45,12 +80,15 @@ class NaivePenalty():
 
         b, c, w, h = probs.shape  # type: Tuple[int, int, int, int]
         k = bounds.shape[2]  # scalar or vector
-        value: Tensor = self.__fn__(probs[:, self.idc, ...])
         lower_b = bounds[:, self.idc, :, 0]
         upper_b = bounds[:, self.idc, :, 1]
+        assert lower_b.shape == upper_b.shape == (b, self.C, k), lower_b.shape
 
+        if self.fused:
+            return SoftSizePenalty.apply(probs, self.idc, lower_b.type(probs.dtype), upper_b.type(probs.dtype))
+
+        value: Tensor = self.__fn__(probs[:, self.idc, ...])
         assert value.shape == (b, self.C, k), value.shape
-        assert lower_b.shape == upper_b.shape == (b, self.C, k), lower_b.shape
 
         too_big: Tensor = (value > upper_b).type(self.dtype)
         too_small: Tensor = (value < lower_b).type(self.dtype)
@@ -1,12 +1,13 @@
 #/usr/bin/env python3.6
 import re
+import math
 import argparse
 import warnings
 from pathlib import Path
 from operator import itemgetter
 from shutil import copytree, rmtree
 import typing
-from typing import Any, Callable, List, Tuple
+from typing import Any, Callable, Dict, List, Tuple
 import matplotlib.pyplot as plt
 import torch
 import numpy as np
@@ -14,15 +15,16 @@ import pandas as pd
 import torch.nn.functional as F
 from torch import Tensor
 from torch.utils.data import DataLoader
-from dice3d import dice3d, dice3dn
+from dice3d import dice3d, PatientDiceAccumulator, PatientVolumes
 from networks import weights_init
-from dataloader import get_loaders
+from layers import convert_domain_bn, set_domain
+from checkpoint import CheckpointWriter, load_model, set_rng_states, snapshot
+from dataloader import get_loaders, DomainPairLoader
 from utils import map_, save_dict_to_file
-from utils import dice_coef, dice_batch, save_images, tqdm_
-from utils import probs2one_hot, probs2class, mask_resize, resize, haussdorf
-from utils import adjust_learning_rate
+from utils import dice_coef, dice_batch, dice_cards, save_images, tqdm_, AsyncImageWriter, EpochArtifacts
+from utils import probs2one_hot, probs2class, mask_resize, resize, haussdorf, volumes_haussdorf
+from utils import adjust_learning_rate, set_validation_level, VALIDATION_LEVELS, StageTimer, augment_batch
 import datetime
-from itertools import cycle
 import os
 
 import matplotlib.pyplot as plt
@@ -34,14 +36,15 @@ def setup(args, n_class, dtype) -> Tuple[Any, Any, Any, List[Callable], List[flo
     device = torch.device("cpu") if cpu else torch.device("cuda")
 
     if args.model_weights:
-        if cpu:
-            net = torch.load(args.model_weights, map_location='cpu')
-        else:
-            net = torch.load(args.model_weights)
+        # Either a whole pickled network, or a state_dict checkpoint
+        net = load_model(args.model_weights, args.network, n_class, 'cpu' if cpu else None, dtype)
     else:
         net_class = getattr(__import__('networks'), args.network)
         net = net_class(1, n_class).type(dtype).to(device)
         net.apply(weights_init)
+    if args.domain_bn:
+        # Before creating the optimizer, as it creates new parameters
+        convert_domain_bn(net)
     net.to(device)
 
     optimizer = torch.optim.Adam(net.parameters(), lr=args.l_rate, betas=(0.9, 0.999))
@@ -72,10 +75,11 @@ def setup(args, n_class, dtype) -> Tuple[Any, Any, Any, List[Callable], List[flo
     return net, optimizer, device, loss_fns, loss_weights, loss_fns_source, loss_weights_source, scheduler
 
 
-def do_epoch(args, mode: str, net: Any, device: Any, loader: DataLoader, epc: int,
+def do_epoch(args, mode: str, net: Any, device: Any, loader: DomainPairLoader, epc: int,
              loss_fns: List[Callable], loss_weights: List[float],loss_fns_source: List[Callable],
              loss_weights_source: List[float], new_w:int, num_steps:int, C: int, metric_axis:List[int], savedir: str = "",
-             optimizer: Any = None, target_loader: Any = None):
+             optimizer: Any = None, volumes: PatientVolumes = None,
+             writer: AsyncImageWriter = None, scaler: Any = None, timer: StageTimer = None, profiler: Any = None):
 
     assert mode in ["train", "val"]
     L: int = len(loss_fns)
@@ -88,29 +92,22 @@ def do_epoch(args, mode: str, net: Any, device: Any, loader: DataLoader, epc: in
         # net.train()
         desc = f">> Validation ({epc})"
 
-    total_it_s, total_images = len(loader), len(loader.dataset)
-    total_it_t, total_images_t = len(target_loader), len(target_loader.dataset)
-    total_iteration = max(total_it_s, total_it_t)
-    # Lazy add lines below because we will be cycling until the biggest length is reached
-    total_images = max(total_images, total_images_t)
-    total_images_t = total_images
+    # (source, target) pairs of the epoch, the shorter domain being cycled
+    n_iterations: int = len(loader)
+    # Gradients are accumulated over args.accumulate iterations, and the lr schedule counts optimizer steps
+    steps_per_epoch: int = num_steps // args.n_epoch
 
     pho=1
     dtype = eval(args.dtype)
+    amp_dtype = get_amp_dtype(args, device)
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
 
-    all_dices: Tensor = torch.zeros((total_images, C), dtype=dtype, device=device)
-    all_inter_card: Tensor = torch.zeros((total_images, C), dtype=dtype, device=device)
-    all_card_gt: Tensor = torch.zeros((total_images, C), dtype=dtype, device=device)
-    all_card_pred: Tensor = torch.zeros((total_images, C), dtype=dtype, device=device)
-    loss_log: Tensor = torch.zeros((total_images), dtype=dtype, device=device)
-    posim_log: Tensor = torch.zeros((total_images), dtype=dtype, device=device)
-    haussdorf_log: Tensor = torch.zeros((total_images, C), dtype=dtype, device=device)
-    all_grp: Tensor = torch.zeros((total_images, C), dtype=dtype, device=device)
-    dice_3d_log: Tensor = torch.zeros((total_images, C), dtype=dtype, device=device)
-    dice_3d_sd_log: Tensor = torch.zeros((total_images, C), dtype=dtype, device=device)
-
+    # Running sums only: O(patients x C) instead of O(slices x C)
+    dice_acc = PatientDiceAccumulator(args.grp_regex, C, device)
+    dice_sum: Tensor = torch.zeros((), dtype=torch.float64, device=device)
+    loss_sum: Tensor = torch.zeros((), dtype=torch.float64, device=device)
 
-    tq_iter = tqdm_(enumerate(zip(loader, target_loader)), total=total_iteration, desc=desc)
+    tq_iter = tqdm_(enumerate(loader), total=n_iterations, desc=desc)
     done: int = 0
     ratio_losses = 0
     n_warmup = 0
@@ -120,10 +117,14 @@ def do_epoch(args, mode: str, net: Any, device: Any, loader: DataLoader, epc: in
     mult_lw[0] = 1
     loss_weights = [a * b for a, b in zip(loss_weights, mult_lw)]
     losses_vec, source_vec, target_vec, baseline_target_vec = [], [], [], []
+    # Disabled: every lap is a no-op, and nothing is synchronized
+    timer = timer or StageTimer(device)
+    timer.start()
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
         for j, (source_data, target_data) in tq_iter:
         #for j, target_data in tq_iter:
+            timer.lap("data")
             source_data[1:] = [e.to(device) for e in source_data[1:]]  # Move all tensors to device
             filenames_source, source_image, source_gt = source_data[:3]
             target_data[1:] = [e.to(device) for e in target_data[1:]]  # Move all tensors to device
@@ -131,22 +132,53 @@ def do_epoch(args, mode: str, net: Any, device: Any, loader: DataLoader, epc: in
             labels = target_data[3:3+L]
             bounds = target_data[3+L:]
             assert len(labels) == len(bounds)
+            timer.lap("h2d")
+            if args.augment and mode == "train":
+                # On the device, once the batch is assembled. Each domain gets its own random transforms
+                source_image, source_gt = augment_batch(source_image, source_gt)
+                target_image, target_gt, *labels = augment_batch(target_image, target_gt, *labels)
+                timer.lap("augment")
+            if args.channels_last:
+                source_image = source_image.contiguous(memory_format=memory_format)
+                target_image = target_image.contiguous(memory_format=memory_format)
             B = len(target_image)
-            # Reset gradients
-            if optimizer:
-                adjust_learning_rate(optimizer, 1, args.l_rate, num_steps, args.power)
+            # Reset gradients, at the first micro-batch of each step
+            group_start: int = j - j % args.accumulate
+            group_size: int = min(args.accumulate, n_iterations - group_start)
+            if optimizer and j == group_start:
+                if not args.flr:  # Poly decay at each optimizer step, --flr keeps the learning rate fixed
+                    adjust_learning_rate(optimizer, epc * steps_per_epoch + j // args.accumulate,
+                                         args.l_rate, num_steps, args.power)
                 optimizer.zero_grad()
 
             # Forward
             with torch.set_grad_enabled(mode == "train"):
-                pred_logits: Tensor = net(target_image)
-                pred_logits_source: Tensor = net(source_image)
+                with torch.autocast(device.type, dtype=amp_dtype, enabled=args.amp):
+                    if args.joint_forward:
+                        # A single forward for both domains: half the kernel launches, twice the batch for BN
+                        if args.domain_bn:
+                            set_domain(net, split=B)
+                        pred_logits_both: Tensor = net(torch.cat((target_image, source_image), dim=0))
+                        pred_logits, pred_logits_source = pred_logits_both[:B], pred_logits_both[B:]
+                        timer.lap("forward_joint")
+                    else:
+                        if args.domain_bn:
+                            set_domain(net, domain=0)
+                        pred_logits: Tensor = net(target_image)
+                        timer.lap("forward_target")
+                        if args.domain_bn:
+                            set_domain(net, domain=1)
+                        pred_logits_source: Tensor = net(source_image)
+                        timer.lap("forward_source")
+                # Back to float32 after autocast: the size penalties sum probabilities over the whole image
+                if args.amp:
+                    pred_logits, pred_logits_source = pred_logits.float(), pred_logits_source.float()
                 pred_probs: Tensor = F.softmax(pred_logits, dim=1)
                 pred_probs_source: Tensor = F.softmax(pred_logits_source, dim=1)
                 if new_w > 0:
                     pred_probs = resize(pred_probs, new_w)
                     labels = [resize(label, new_w) for label in labels]
-                    target = resize(target, new_w)
+                    target_gt = resize(target_gt, new_w)
                 predicted_mask: Tensor = probs2one_hot(pred_probs)  # Used only for dice computation    
             assert len(bounds) == len(loss_fns) == len(loss_weights)
             if epc < n_warmup:
@@ -163,56 +195,93 @@ def do_epoch(args, mode: str, net: Any, device: Any, loader: DataLoader, epc: in
             for loss_fn, label, w, bound in zip(loss_fns_source, [source_gt], loss_weights_source, torch.randn(1)):
                 if w > 0:
                     loss =loss+ w * loss_fn(pred_probs_source, label, bound)
+            timer.lap("loss")  # Includes the softmax, resize and one-hot of the predictions
 
             # Backward
             if optimizer:
-                loss.backward()
-                optimizer.step()
+                # Pass-through when the scaler is disabled (no amp, or bfloat16)
+                # Each loss is already a mean over its micro-batch: averaging them gives the loss of the whole step
+                scaler.scale(loss / group_size).backward()
+                timer.lap("backward")
+                if j + 1 == group_start + group_size:
+                    scaler.step(optimizer)
+                    scaler.update()
+                    timer.lap("step")
 
             # Compute and log metrics
-            dices, inter_card, card_gt, card_pred = dice_coef(predicted_mask.detach(), target_gt.detach())
+            inter_card, card_gt, card_pred = dice_cards(target_gt.detach(), predicted_mask.detach())
+            dices: Tensor = (2 * inter_card + 1e-8) / (card_gt + card_pred + 1e-8)
             assert dices.shape == (B, C), (dices.shape, B, C)
-            
-            sm_slice = slice(done, done + B)  # Values only for current batch
-            all_dices[sm_slice, ...] = dices
-            # # for 3D dice
-            all_grp[sm_slice, ...] = int(re.split('_', filenames_target[0])[1]) * torch.ones([1, C])
-            all_inter_card[sm_slice, ...] = inter_card
-            all_card_gt[sm_slice, ...] = card_gt
-            all_card_pred[sm_slice, ...] = card_pred
-            loss_log[sm_slice] = loss.detach()
-            
+
+            dice_acc.update(filenames_target, inter_card, card_gt, card_pred)
+            dice_sum += torch.index_select(dices, 1, indices).mean(dim=1).sum()
+            loss_sum += loss.detach().sum() * B
+            timer.lap("metrics")
+
             # # Save images
-            if savedir:
+            if volumes is not None:
+                volumes.add(probs2class(pred_probs), target_gt.argmax(dim=1), filenames_target)
+            elif savedir:
                 with warnings.catch_warnings():
                     warnings.filterwarnings("ignore", category=UserWarning)
                     warnings.simplefilter("ignore") 
                     predicted_class: Tensor = probs2class(pred_probs)
-                    save_images(predicted_class, filenames_target, savedir, mode, epc, True)
+                    if writer is not None:
+                        writer.submit(predicted_class, filenames_target, savedir, mode, epc, True)
+                    else:
+                        save_images(predicted_class, filenames_target, savedir, mode, epc, True,
+                                    args.save_format, args.png_compression)
             
+            timer.lap("save")
+
             # Logging
-            big_slice = slice(0, done + B)  # Value for current and previous batches
-            stat_dict = {"dice": torch.index_select(all_dices, 1, indices).mean(),
-                         "loss": loss_log[big_slice].mean()}
-            nice_dict = {k: f"{v:.4f}" for (k, v) in stat_dict.items()}
-            
             done += B
+            stat_dict = {"dice": dice_sum / done,
+                         "loss": loss_sum / done}
+            nice_dict = {k: f"{v:.4f}" for (k, v) in stat_dict.items()}
+
             tq_iter.set_postfix(nice_dict)
+            timer.lap("log")  # Formatting the running sums waits for the device
+            if profiler is not None:
+                profiler.step()
         print(f"{desc} " + ', '.join(f"{k}={v}" for (k, v) in nice_dict.items()))
 
-    dice_3d_log, dice_3d_sd_log = dice3dn(all_grp, all_inter_card, all_card_gt, all_card_pred,metric_axis,True)
+    dice_3d_log, dice_3d_sd_log = dice_acc.compute(metric_axis)
     print("mean 3d_dice over all patients:",dice_3d_log)
     target_vec = [ dice_3d_log, dice_3d_sd_log]
 
-    losses_vec = [loss_log.mean().item()]
+    losses_vec = [(loss_sum / max(done, 1)).item()]
     return losses_vec, target_vec
 
 
+def get_amp_dtype(args: argparse.Namespace, device: Any) -> Any:
+    # float16 needs the GradScaler, bfloat16 has the range of float32 and is what cpus support
+    if args.amp_dtype == "auto":
+        return torch.bfloat16 if device.type == "cpu" else torch.float16
+    return getattr(torch, args.amp_dtype)
+
+
+def get_profiler(args: argparse.Namespace, savedir: str) -> Any:
+    # Skips the first steps (worker startup, cudnn autotuning), then traces --profile_steps training steps
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available() and not args.cpu:
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    return torch.profiler.profile(activities=activities,
+                                  schedule=torch.profiler.schedule(wait=args.profile_skip, warmup=1,
+                                                                   active=args.profile_steps, repeat=1),
+                                  on_trace_ready=torch.profiler.tensorboard_trace_handler(str(Path(savedir,
+                                                                                                   "profile"))),
+                                  record_shapes=True, with_stack=False)
+
+
 def run(args: argparse.Namespace) -> None:
     # save args to dict
     d = vars(args)
     d['time'] = str(datetime.datetime.now())
     save_dict_to_file(d,args.workdir)
+    # Before creating the loaders, so that the workers inherit it
+    set_validation_level(args.validation, args.validation_every)
 
     temperature: float = 0.1
     n_class: int = args.n_class
@@ -226,31 +295,76 @@ def run(args: argparse.Namespace) -> None:
 
     net, optimizer, device, loss_fns, loss_weights, loss_fns_source, loss_weights_source, scheduler = setup(args, n_class, dtype)
     print(f'> Loss weights cons: {loss_weights}, Loss weights source:{loss_weights_source}')
+    if args.channels_last:
+        net = net.to(memory_format=torch.channels_last)
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp and get_amp_dtype(args, device) == torch.float16)
     shuffle = False
     if args.mix:
         shuffle = True
     #print("args.dataset",args.dataset)
     loader, loader_val = get_loaders(args, args.dataset,args.folders,
                                            args.batch_size, n_class,
-                                           args.debug, args.in_memory, dtype, False,fix_size=[0,0])
+                                           args.debug, args.in_memory, dtype, False, args.fg_index)
 
+    # The target ground truth is never used for training: stratified only on what --target_fg_index points to
     target_loader, target_loader_val = get_loaders(args, args.target_dataset,args.target_folders,
                                            args.batch_size, n_class,
-                                           args.debug, args.in_memory, dtype, shuffle,fix_size=[0,0])
+                                           args.debug, args.in_memory, dtype, shuffle, args.target_fg_index)
+
+    # --steps_per_epoch pairs (by default, the longest domain), the shorter domain is cycled. Both restart at each
+    # epoch, so that --resume gets the same batches. The validation goes exactly once through the target patients
+    train_pairs = DomainPairLoader(args, loader, target_loader, args.steps_per_epoch, continuous=False,
+                                   shared=args.shared_workers)
+    val_pairs = DomainPairLoader(args, loader_val, target_loader_val, len(target_loader_val), continuous=False,
+                                 shared=args.shared_workers)
 
-    num_steps = n_epoch * len(loader)
+    # Optimizer steps, not iterations
+    num_steps = n_epoch * math.ceil(len(train_pairs) / args.accumulate)
     #print(num_steps)
     print("metric axis",metric_axis)
     best_dice_pos: Tensor = np.zeros(1)
     best_dice: Tensor = np.zeros(1)
     best_3d_dice: Tensor = np.zeros(1)
+    best_epoch: int = 0
+    start_epoch: int = 0
+    df_t: pd.DataFrame = None
+
+    if args.resume:
+        state = torch.load(args.resume, map_location='cpu', weights_only=False)
+        net.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        if state.get("scaler"):
+            scaler.load_state_dict(state["scaler"])
+        set_rng_states(state["rng"])
+        start_epoch = state["epoch"] + 1
+        df_t = state["metrics"]
+        best_3d_dice, best_epoch = state["best_3d_dice"], state["best_epoch"]
+        print(f">>> Resuming from {args.resume} at epoch {start_epoch}, best 3d dice {best_3d_dice} at {best_epoch}")
+
+    checkpointer = CheckpointWriter()
+    # Writes the validation predictions in the background
+    writer: AsyncImageWriter = None
+    if args.save_workers > 0:
+        writer = AsyncImageWriter(args.save_workers, fmt=args.save_format, compress_level=args.png_compression)
+
+    artifacts = EpochArtifacts(savedir)
+    timer = StageTimer(device, enabled=args.timing)
 
     print("Results saved in ", savedir)
     print(">>> Starting the training")
-    for i in range(n_epoch):
+    for i in range(start_epoch, n_epoch):
+        # Validation predictions stay in memory, and only the best and last epochs are written
+        val_volumes: PatientVolumes = PatientVolumes(args.grp_regex) if args.in_memory_eval else None
+        for l in [loader, target_loader]:
+            if hasattr(l.batch_sampler, "set_epoch"):  # Reshuffled from (seed, epoch): same batches on --resume
+                l.batch_sampler.set_epoch(i)
+        profiler = None
+        if args.profile_steps and i == args.profile_epoch:
+            profiler = get_profiler(args, savedir)
+            profiler.start()
 
         tra_losses_vec, tra_target_vec                                    = do_epoch(args, "train", net, device,
-                                                                                           loader, i, loss_fns,
+                                                                                           train_pairs, i, loss_fns,
                                                                                            loss_weights,
                                                                                            loss_fns_source,
                                                                                            loss_weights_source,
@@ -258,18 +372,28 @@ def run(args: argparse.Namespace) -> None:
                                                                                            num_steps, n_class, metric_axis,
                                                                                            savedir="",
                                                                                            optimizer=optimizer,
-                                                                                           target_loader=target_loader)
+                                                                                           scaler=scaler,
+                                                                                           timer=timer,
+                                                                                           profiler=profiler)
+        if profiler is not None:
+            profiler.stop()
+            print(f">>> Profiler trace saved in {Path(savedir, 'profile')}")
+        tra_timings: Dict[str, float] = timer.summary("tra_time")
 
         with torch.no_grad():
             val_losses_vec, val_target_vec                                        = do_epoch(args, "val", net, device,
-                                                                                               loader_val, i, loss_fns,
+                                                                                               val_pairs, i, loss_fns,
                                                                                                loss_weights,
                                                                                                loss_fns_source,
                                                                                                loss_weights_source,
                                                                                                args.resize,
                                                                                                num_steps, n_class,metric_axis,
                                                                                                savedir=savedir,
-                                                                                               target_loader=target_loader_val)
+                                                                                               volumes=val_volumes,
+                                                                                               writer=writer,
+                                                                                               timer=timer)
+        if writer is not None:
+            writer.flush()  # The whole epoch is on disk before being copied or removed
 
 
         df_t_tmp = pd.DataFrame({
@@ -279,42 +403,62 @@ def run(args: argparse.Namespace) -> None:
             "tra_dice_3d_sd": [tra_target_vec[1]],
             "val_dice_3d": [val_target_vec[0]],
             "val_dice_3d_sd": [val_target_vec[1]]})
-
-        if i == 0:
+        # Seconds spent in each stage of the epochs, only with --timing
+        for key, value in {**tra_timings, **timer.summary("val_time")}.items():
+            df_t_tmp[key] = [value]
+
+        if args.hd_percentile:
+            # 3d distance per patient, averaged over the metric classes present in both the prediction and the gt
+            hds: np.ndarray = volumes_haussdorf(val_volumes.volumes().values(), n_class,
+                                                args.hd_percentile, args.hd_workers)[:, metric_axis]
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=RuntimeWarning)  # All nan for a patient
+                per_patient: np.ndarray = np.nanmean(hds, axis=1)
+            df_t_tmp["val_hd_3d"] = [np.nanmean(per_patient)]
+            df_t_tmp["val_hd_3d_sd"] = [np.nanstd(per_patient)]
+            print(f"mean 3d HD{args.hd_percentile:g} over all patients: {df_t_tmp['val_hd_3d'][0]:.4f}")
+
+        if df_t is None:
             df_t = df_t_tmp
         else:
-            df_t = df_t.append(df_t_tmp)
+            df_t = pd.concat([df_t, df_t_tmp])
 
         df_t.to_csv(Path(savedir, "_".join(("target", args.csv))), float_format="%.4f", index_label="epoch")
 
         # Save model if better
         current_val_target_3d_dice = val_target_vec[0]
+        is_best: bool = current_val_target_3d_dice > best_3d_dice
+        is_last: bool = i == n_epoch - 1
 
-        if current_val_target_3d_dice > best_3d_dice:
+        if is_best:
             best_epoch = i
             best_3d_dice = current_val_target_3d_dice
             with open(Path(savedir, "best_epoch_3d.txt"), 'w') as f:
                 f.write(str(i))
-            best_folder_3d = Path(savedir, "best_epoch_3d")
-            if best_folder_3d.exists():
-                rmtree(best_folder_3d)
-            copytree(Path(savedir, f"iter{i:03d}"), Path(best_folder_3d))
-            torch.save(net, Path(savedir, "best_3d.pkl"))
 
-        if i == n_epoch - 1:
+        if is_last:
             with open(Path(savedir, "last_epoch.txt"), 'w') as f:
                 f.write(str(i))
-            last_folder = Path(savedir, "last_epoch")
-            if last_folder.exists():
-                rmtree(last_folder)
-            copytree(Path(savedir, f"iter{i:03d}"), Path(last_folder))
-            torch.save(net, Path(savedir, "last.pkl"))
-
-        # remove images from iteration
-        rmtree(Path(savedir, f"iter{i:03d}"))
 
-        if args.flr==False:
-            adjust_learning_rate(optimizer, i, args.l_rate, n_epoch, 0.9)
+        if val_volumes is not None and (is_best or is_last):
+            val_volumes.export(Path(artifacts.staging(i), "val"), True, args.save_format, args.png_compression)
+
+        # Renames the images of the iteration into best_epoch_3d/last_epoch, or removes them in the background
+        artifacts.end_epoch(i, is_best, is_last)
+
+        # state_dicts of the end of the epoch, enough to --resume from the next one
+        state = snapshot(net, optimizer, i, metrics=df_t.copy(), best_3d_dice=best_3d_dice, best_epoch=best_epoch,
+                         scaler=scaler.state_dict(), domain_bn=args.domain_bn)
+        checkpoint_paths: List[Path] = [Path(savedir, "checkpoint.pth")]
+        if is_best:
+            checkpoint_paths.append(Path(savedir, "best_3d.pth"))
+        if is_last:
+            checkpoint_paths.append(Path(savedir, "last.pth"))
+        checkpointer.save(state, *checkpoint_paths)
+    if writer is not None:
+        writer.close()
+    artifacts.close()
+    checkpointer.close()
     print("Results saved in ", savedir)
 
 
@@ -336,14 +480,30 @@ def get_args() -> argparse.Namespace:
     parser.add_argument("--n_class", type=int, required=True)
 
     parser.add_argument("--lin_aug_w", action="store_true")
-    parser.add_argument("--flr", action="store_true")
-    parser.add_argument("--augment", action="store_true")
+    parser.add_argument("--flr", action="store_true", help="Fixed learning rate, without the poly decay")
+    parser.add_argument("--augment", action="store_true",
+                        help="Random flips and rotations of the training batches, on the device")
     parser.add_argument("--mix", type=bool, default=True)
     parser.add_argument("--debug", action="store_true")
     parser.add_argument("--csv", type=str, default='metrics.csv')
     parser.add_argument("--model_weights", type=str, default='')
+    parser.add_argument("--resume", type=str, default='',
+                        help="checkpoint.pth of an interrupted run, to restart from the epoch after it")
     parser.add_argument("--cpu", action='store_true')
     parser.add_argument("--in_memory", action='store_true')
+    parser.add_argument("--in_memory_eval", action='store_true',
+                        help="Keep the validation predictions in memory, and write only the best and last epochs")
+    parser.add_argument("--hd_percentile", type=float, default=0,
+                        help="Compute the 3d Hausdorff distance of each validation patient at each epoch: "
+                             "100 for the HD, 95 for the HD95. 0 to disable. Requires --in_memory_eval")
+    parser.add_argument("--hd_workers", type=int, default=4)
+    parser.add_argument("--save_workers", type=int, default=0,
+                        help="Threads writing the predictions in the background, 0 to write them synchronously")
+    parser.add_argument("--save_format", type=str, default="png", choices=["png", "npy"])
+    parser.add_argument("--png_compression", type=int, default=6, choices=range(10),
+                        help="zlib level of the saved pngs: 1 is much faster to encode than the default 6")
+    parser.add_argument("--packed", action='store_true',
+                        help="Read the slices from the arrays created by pack.py instead of decoding the pngs")
     parser.add_argument("--resize", type=int, default=0)
     parser.add_argument("--pho", nargs='?', type=float, default=1,
                         help='augment')
@@ -354,16 +514,64 @@ def get_args() -> argparse.Namespace:
     parser.add_argument('--weight_decay', nargs='?', type=float, default=1e-5,
                         help='L2 regularisation of network weights')
     parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument("--num_workers", type=int, default=10, help="Workers of each dataloader")
+    parser.add_argument("--pin_memory", type=int, default=1, choices=[0, 1])
+    parser.add_argument("--persistent_workers", action='store_true',
+                        help="Keep the workers alive between epochs instead of forking them again")
+    parser.add_argument("--prefetch_factor", type=int, default=2, help="Batches loaded in advance by each worker")
+    parser.add_argument("--shared_workers", action='store_true',
+                        help="One worker pool for both domains, instead of one per domain")
+    parser.add_argument("--steps_per_epoch", type=int, default=0,
+                        help="(source, target) pairs per training epoch, 0 for the length of the longest domain")
+    parser.add_argument("--train_sampler", type=str, default="random", choices=["random", "patient", "foreground"],
+                        help="Training batches: shuffled slices, slices of the same patient, or stratified by "
+                             "foreground presence. The last two are seeded by --seed and the epoch.")
+    parser.add_argument("--fg_index", type=int, default=1,
+                        help="Index in --folders of the ground truth stratified by --train_sampler foreground")
+    parser.add_argument("--target_fg_index", type=int, default=-1,
+                        help="Same in --target_folders, e.g. the weak labels. Negative: the target batches are "
+                             "shuffled slices, as its ground truth cannot be used")
+    parser.add_argument("--val_batch_size", type=int, default=0,
+                        help="Fixed-size validation batches, patient after patient. 0 for one patient per batch.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument('--accumulate', type=int, default=1,
+                        help="Micro-batches of --batch_size accumulated for each optimizer step")
     parser.add_argument("--dtype", type=str, default="torch.float32")
+    parser.add_argument("--amp", action='store_true',
+                        help="Forward passes under autocast, with a GradScaler for float16. Losses stay in float32")
+    parser.add_argument("--amp_dtype", type=str, default="auto", choices=["auto", "float16", "bfloat16"],
+                        help="auto: bfloat16 on cpu, float16 on gpu")
+    parser.add_argument("--joint_forward", action='store_true',
+                        help="Concatenate the target and source batches into a single forward pass")
+    parser.add_argument("--domain_bn", action='store_true',
+                        help="Separate BatchNorm statistics and affine parameters for the target and the source")
+    parser.add_argument("--channels_last", action='store_true',
+                        help="channels_last memory format for the network and its inputs")
     parser.add_argument("--scheduler", type=str, default="DummyScheduler")
     parser.add_argument("--scheduler_params", type=str, default="{}")
     parser.add_argument("--bounds_on_fgt", type=bool, default=False)
-    parser.add_argument("--bounds_on_train_stats", type=str, default='')
+    parser.add_argument("--bounds_on_train_stats", type=str, default='',
+                        help="Folder of <slice>_stats.csv files, or the single file indexed by precompute_bounds.py")
+    parser.add_argument("--bounds_table", action='store_true',
+                        help="Load the bounds from the tables created by precompute_bounds.py")
     parser.add_argument("--power",type=float, default=0.9)
+    parser.add_argument("--timing", action='store_true',
+                        help="Wall time of each stage of the epochs in the metrics csv. Synchronizes the device.")
+    parser.add_argument("--profile_steps", type=int, default=0,
+                        help="Number of training steps to trace with torch.profiler, 0 to disable")
+    parser.add_argument("--profile_epoch", type=int, default=0)
+    parser.add_argument("--profile_skip", type=int, default=5, help="Steps to skip before tracing")
+    parser.add_argument("--validation", type=str, choices=VALIDATION_LEVELS,
+                        default=os.environ.get("CDA_VALIDATION", "full"),
+                        help="How the invariants (simplex, one-hot, ...) are asserted: off, cheap (range checks, still "
+                             "a sync per call), sampled (full check every --validation_every calls, none otherwise) "
+                             "or full. Default: $CDA_VALIDATION")
+    parser.add_argument("--validation_every", type=int, default=int(os.environ.get("CDA_VALIDATION_EVERY", 100)))
     parser.add_argument("--metric_axis",type=int, nargs='*', required=True, help="Classes to display metrics. \
         Display only the average of everything if empty")
     args = parser.parse_args()
     print(args)
+    assert not args.hd_percentile or args.in_memory_eval, "--hd_percentile needs the volumes of --in_memory_eval"
 
     return args
 
@@ -9,7 +9,6 @@ import torchvision.models as models
 from torch import nn
 from torch import Tensor
 
-from utils import compose_acc
 from layers import upSampleConv, conv_block_1, conv_block_3_3, conv_block_Asym
 from layers import conv_block, conv_block_3, maxpool, conv_decod_block
 from layers import convBatch, residualConv  # Imports for UNEt
@@ -179,8 +178,8 @@ class BottleNeckNormal(nn.Module):
         self.do = nn.Dropout(p=dropoutRate)
         self.PReLU_out = nn.PReLU()
 
-        if in_dim > out_dim:
-            self.conv_out = conv_block_1(in_dim, out_dim)
+        # Identity (no parameters) otherwise, so that the attribute always exists when scripting
+        self.conv_out = conv_block_1(in_dim, out_dim) if in_dim > out_dim else nn.Identity()
 
     def forward(self, input):
         # Main branch
@@ -214,8 +213,8 @@ class BottleNeckNormal_Asym(nn.Module):
         self.do = nn.Dropout(p=dropoutRate)
         self.PReLU_out = nn.PReLU()
 
-        if in_dim > out_dim:
-            self.conv_out = conv_block_1(in_dim, out_dim)
+        # Identity (no parameters) otherwise, so that the attribute always exists when scripting
+        self.conv_out = conv_block_1(in_dim, out_dim) if in_dim > out_dim else nn.Identity()
 
     def forward(self, input):
         # Main branch
@@ -531,7 +530,13 @@ class fcn8s(nn.Module):
         self.init_vgg16_params(vgg16)
 
     def forward(self, x):
-        _, _, _, conv3, conv4, _, score = compose_acc(self.forward_path, x)
+        # Same as compose_acc(self.forward_path, x), spelled out so that the model can be scripted
+        conv1 = self.conv1(x)
+        conv2 = self.conv2(conv1)
+        conv3 = self.conv3(conv2)
+        conv4 = self.conv4(conv3)
+        conv5 = self.conv5(conv4)
+        score = self.classifier(conv5)
 
         score_pool4 = self.score_pool4(conv4)
         score_pool3 = self.score_pool3(conv3)
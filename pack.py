@@ -0,0 +1,76 @@
+#!/usr/bin/env python3.6
+
+import argparse
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from utils import mmap_
+from dataloader import pack_paths, list_names
+
+
+def read_png(path: Path) -> np.ndarray:
+    return np.array(Image.open(path).convert('L'), dtype=np.uint8)
+
+
+def pack_folder(folder: Path, names: List[str] = None) -> Tuple[int, int, int]:
+    """
+    Decode once all the slices of a folder into a single contiguous (N, H, W) uint8 array (rows first, as read_png),
+    with its filename index. Slices are written one at a time into the memory mapped output, so that the whole
+    split is never held in RAM.
+    """
+    if names is None:
+        names = list_names(folder)
+    assert names, folder
+
+    array_path, index_path = pack_paths(folder)
+
+    shape: Tuple[int, ...] = read_png(Path(folder, names[0])).shape
+    pack: np.ndarray = np.lib.format.open_memmap(str(array_path), mode='w+', dtype=np.uint8,
+                                                 shape=(len(names), *shape))
+    for i, name in enumerate(names):
+        img: np.ndarray = read_png(Path(folder, name))
+        if img.shape != shape:
+            raise ValueError(f"{Path(folder, name)} has shape {img.shape}, expected {shape}")
+        pack[i] = img
+    pack.flush()
+    del pack
+
+    with open(index_path, 'w') as f:
+        f.write('\n'.join(names) + '\n')
+
+    return (len(names), *shape)
+
+
+def main(args: argparse.Namespace) -> None:
+    todo: List[Path] = []
+    for split in args.splits:
+        split_folders: List[Path] = [Path(args.dataset, split, f) for f in args.folders]
+        # Same convention as the dataloader: the filenames of the first folder are used for all of them
+        names: List[str] = list_names(split_folders[0])
+        todo += split_folders
+
+        for folder in split_folders:
+            missing: List[str] = [n for n in names if not Path(folder, n).exists()]
+            assert not missing, (folder, missing[:5])
+
+    for folder, shape in zip(todo, mmap_(pack_folder, todo)):
+        print(f"Packed {folder} into {pack_paths(folder)[0]} with shape {shape}")
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Pack the png slices of each folder into a single memory mapped array')
+    parser.add_argument('--dataset', type=str, required=True)
+    parser.add_argument('--folders', type=str, nargs='+', required=True,
+                        help="Subfolders to pack, e.g. IP GT")
+    parser.add_argument('--splits', type=str, nargs='*', default=['train', 'val'])
+    args = parser.parse_args()
+    print(args)
+
+    return args
+
+
+if __name__ == "__main__":
+    main(get_args())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3.6
+
+import argparse
+from pathlib import Path
+from typing import List
+
+import torch
+import numpy as np
+from torch.utils.data import DataLoader
+
+from bounds import bounds_hash
+from utils import tqdm_
+from dataloader import get_loaders, SliceDataset, load_train_stats, save_train_stats
+
+
+def precompute(dataset: SliceDataset, losses: List, n_class: int, spec: str, on_fgt: bool, resize: int,
+               num_workers: int) -> Path:
+    split_folder: Path = dataset.folders[0].parent
+    folders: List[str] = [f.name for f in dataset.folders]
+    save_path: Path = Path(split_folder, f"bounds_{bounds_hash(losses, n_class, spec, on_fgt, resize)}.npz")
+
+    # Each item is [filename] + tensors + bounds, and the fgt tensor is removed when computing the bounds on it
+    n_tensors: int = len(folders) - (1 if on_fgt else 0)
+
+    names: List[str] = []
+    all_bounds: List[List[np.ndarray]] = []
+    loader = DataLoader(dataset, batch_size=None, num_workers=num_workers)
+    for item in tqdm_(loader, total=len(dataset), desc=f">> Bounds ({split_folder})"):
+        filename, bounds = item[0], item[1 + n_tensors:]
+        names.append(filename)
+        all_bounds.append([b.type(torch.float32).numpy() for b in bounds])
+
+    tables = {f"bounds_{i}": np.stack(b, axis=0) for (i, b) in enumerate(zip(*all_bounds))}
+    np.savez(save_path, names=np.array(names), **tables)
+    print(f"Saved {len(names)} bounds into {save_path}: " + ', '.join(f"{k}{v.shape}" for (k, v) in tables.items()))
+
+    return save_path
+
+
+def main(args: argparse.Namespace) -> None:
+    if args.train_stats:
+        # Only pack the folder used by --bounds_on_train_stats into a single file
+        index = load_train_stats(args.train_stats)
+        save_train_stats(index, args.save_stats)
+        print(f"Saved the stats of {len(index)} slices into {args.save_stats}")
+        return
+
+    assert args.dataset and args.folders and args.losses and args.grp_regex and args.n_class
+
+    # Bounds are always computed from the decoded tensors, never from a previous table
+    args.bounds_table = False
+    args.bounds_on_train_stats = ''
+    args.train_sampler, args.val_batch_size = "random", 0
+    args.pin_memory, args.persistent_workers, args.prefetch_factor = False, False, 2
+
+    losses = eval(args.losses)
+    train_loader, val_loader = get_loaders(args, args.dataset, args.folders,
+                                           1, args.n_class,
+                                           False, False, torch.float32, False)
+    for loader in [train_loader, val_loader]:
+        precompute(loader.dataset, losses, args.n_class, args.folders, args.bounds_on_fgt, args.resize,
+                   args.num_workers)
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Precompute the bounds of each slice, for a given bounds configuration')
+    parser.add_argument('--dataset', type=str, default='')
+    parser.add_argument("--folders", type=str, default='',
+                        help="List of (subfolder, transform, is_hot), same as the --target_folders of main.py")
+    parser.add_argument("--losses", type=str, default='',
+                        help="List of (loss_name, loss_params, bounds_name, bounds_params, fn, weight)")
+    parser.add_argument("--grp_regex", type=str, default='')
+    parser.add_argument("--n_class", type=int, default=0)
+    parser.add_argument("--bounds_on_fgt", type=bool, default=False)
+    parser.add_argument("--packed", action='store_true')
+    parser.add_argument("--resize", type=int, default=0, help="Same as main.py, part of the key of the table")
+    parser.add_argument("--num_workers", type=int, default=10)
+    parser.add_argument("--train_stats", type=str, default='',
+                        help="Folder of <slice>_stats.csv files to index into --save_stats, instead of computing bounds")
+    parser.add_argument("--save_stats", type=str, default='train_stats.npz')
+    args = parser.parse_args()
+    print(args)
+
+    return args
+
+
+if __name__ == "__main__":
+    main(get_args())
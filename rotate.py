@@ -3,13 +3,16 @@
 import argparse
 import re
 from pathlib import Path
-from typing import List, Match, Pattern
+from multiprocessing import Pool
+from typing import Dict, List, Set, Tuple
 import numpy as np
-from utils import map_, resize_im
+from PIL import Image
 from argparse import Namespace
 import os
 import shutil
-import imageio
+
+from pack import read_png
+from dataloader import group_patients, pack_paths
 
 
 def main(args: Namespace) -> None:
@@ -51,61 +54,106 @@ def main(args: Namespace) -> None:
                     os.mkdir(args.save_folder)
                 s_path.parent.mkdir(exist_ok=True)
                 s_path.mkdir(exist_ok=True)
-            if args.rot == 'rot':
-                rotate(r_path, args.grp_regex, s_path)
-            if args.rot == 'rot_back':
-                rotate_back(r_path, args.grp_regex, s_path)
-
-
-def rotate(r_path, grp_regex, s_path):
-    filenames = [f for f in os.listdir(r_path) if f.endswith('.png')]
-    # Might be needed in case of escape sequence problems
-    # self.grp_regex = bytes(grp_regex, "utf-8").decode('unicode_escape')
-    grouping_regex: Pattern = re.compile(grp_regex)
-
-    stems: List[str] = [Path(filename).stem for filename in filenames]  # avoid matching the extension
-    matches: List[Match] = map_(grouping_regex.match, stems)
-    patients: List[str] = [match.group(0) for match in matches]
-
-    unique_patients: List[str] = list(set(patients))
-
-    for patient in unique_patients:
-        patient_slices = [f for f in stems if f.startswith(patient)]
-        w,h = [256,256]
-        n = len(patient_slices)
-        t = np.ndarray(shape=(w, h, n))
-        for slice in patient_slices:
-            slice_nb = int(re.split(grp_regex, slice)[1])
-            t[:, :, slice_nb] = imageio.imread(r_path+'/'+slice+'.png')
-        for i in range(0, h):
-            im = np.pad(t[i,:,:], [(0, 0), (110, 110)], 'constant')
-            imageio.imwrite(s_path+'/'+patient+str(i)+'.png', im)
-
-
-def rotate_back(r_path, grp_regex, s_path):
-    filenames = [f for f in os.listdir(r_path) if f.endswith('.png')]
-    grouping_regex: Pattern = re.compile(grp_regex)
-
-    stems: List[str] = [Path(filename).stem for filename in filenames]  # avoid matching the extension
-    matches: List[Match] = map_(grouping_regex.match, stems)
-    patients: List[str] = [match.group(0) for match in matches]
-
-    unique_patients: List[str] = list(set(patients))
-    print(unique_patients)
-    for patient in unique_patients:
-        patient_slices = [f for f in stems if f.startswith(patient)]
-        w,h = [256,36]
-        n = len(patient_slices)
-        t = np.ndarray(shape=(w, h, n))
-        for slice in patient_slices:
-            slice_nb = int(re.split(grp_regex, slice)[1])
-            im_or = imageio.imread(str(r_path)+'/'+slice+'.png')
-            if im_or.shape !=(w,h):
-                im_or = resize_im(im_or, 36)
-            t[:, :, slice_nb] = im_or
-        for i in range(0, h):
-            im = t[:,i,:]
-            imageio.imwrite(str(s_path)+'/'+patient+str(i)+'.png', im)
+            reorient(r_path, args.grp_regex, s_path, args.rot, args.pad, args.packed, args.workers)
+
+
+def slice_index(stem: str, grp_regex: str) -> int:
+    # Position of the slice in its patient volume: what follows the patient id, e.g. Subj_1_12 -> 12
+    return int(re.split(grp_regex, stem)[1])
+
+
+def output_layout(first_slice: Path, n: int, rot: str, pad: int) -> Tuple[int, Tuple[int, int]]:
+    # Number and shape of the slices written for a patient, from the header of one of its slices only
+    width, height = Image.open(first_slice).size
+    w, h = height, width  # numpy order
+    if rot == 'rot':
+        return w, (h, n + 2 * pad)
+    if rot == 'rot_back':  # Same crop as read_volume
+        return (h - 2 * pad if h > 2 * pad else h), (w, n)
+    raise ValueError(rot)
+
+
+def read_volume(r_path: Path, stems: List[str], grp_regex: str, pad: int, crop: bool) -> np.ndarray:
+    # (w, h, n) uint8 volume of a patient, slices placed by their index. Cropped by pad on each side of h, unless
+    # already cropped (h <= 2 * pad), as are the predictions saved with --resize. Offset by one, as resize_im does
+    slices: List[np.ndarray] = [read_png(Path(r_path, f"{stem}.png")) for stem in stems]
+    if crop and pad:
+        slices = [s[:, pad - 1:s.shape[1] - pad - 1] if s.shape[1] > 2 * pad else s for s in slices]
+    assert len(set(s.shape for s in slices)) == 1, (r_path, stems[0])
+    assert slices[0].size > 0, (r_path, stems[0], slices[0].shape)
+
+    volume: np.ndarray = np.zeros((*slices[0].shape, len(slices)), dtype=np.uint8)
+    for stem, s in zip(stems, slices):
+        volume[:, :, slice_index(stem, grp_regex)] = s
+
+    return volume
+
+
+def reorient_patient(job: Tuple[Path, List[str], str, str, int]) -> Tuple[List[str], np.ndarray]:
+    """
+    rot: slices of the volume along its first axis, padded with pad zeros on both sides of the slice axis.
+    rot_back: the inverse, on slices of width h - 2 * pad once cropped (if wider than 2 * pad), along the second axis.
+    Returns the new names and the (N, H, W) uint8 slices of the patient.
+    """
+    r_path, stems, grp_regex, rot, pad = job
+    patient: str = re.match(grp_regex, stems[0]).group(0)
+
+    volume: np.ndarray = read_volume(r_path, stems, grp_regex, pad, crop=rot == 'rot_back')
+    if rot == 'rot':
+        res = np.pad(volume, [(0, 0), (0, 0), (pad, pad)], 'constant')
+    else:
+        res = volume.transpose(1, 0, 2)
+    names: List[str] = [f"{patient}{i}.png" for i in range(len(res))]
+
+    return names, np.ascontiguousarray(res)
+
+
+def write_patient(job: Tuple[Path, List[str], str, str, int, Path]) -> int:
+    names, slices = reorient_patient(job[:5])
+    s_path: Path = job[5]
+    for name, s in zip(names, slices):
+        Image.fromarray(s).save(Path(s_path, name))
+
+    return len(names)
+
+
+def reorient(r_path: Path, grp_regex: str, s_path: Path, rot: str, pad: int = 110, packed: bool = False,
+             workers: int = None) -> None:
+    """
+    One patient volume at a time per process, in uint8. With packed, the slices go directly in the pack of s_path
+    (same format as pack.py): its size is known beforehand from the slice headers, and the parent process writes
+    each patient into it as soon as a worker returns it.
+    """
+    stems: List[str] = [Path(f).stem for f in sorted(os.listdir(r_path)) if f.endswith('.png')]
+    idx_map: Dict[str, List[int]] = group_patients(stems, grp_regex)
+    jobs = [(Path(r_path), [stems[i] for i in idx], grp_regex, rot, pad) for idx in idx_map.values()]
+    print(f"Found {len(jobs)} patients and {len(stems)} slices in {r_path}")
+
+    with Pool(workers) as pool:
+        if not packed:
+            n: int = sum(pool.imap_unordered(write_patient, [(*job, Path(s_path)) for job in jobs]))
+            print(f"Wrote {n} slices in {s_path}")
+            return
+
+        layouts = [output_layout(Path(r_path, f"{job[1][0]}.png"), len(job[1]), rot, pad) for job in jobs]
+        shapes: Set[Tuple[int, int]] = set(shape for (_, shape) in layouts)
+        assert len(shapes) == 1, f"All the patients need the same slice shape to be packed, got {shapes}"
+        total: int = sum(count for (count, _) in layouts)
+
+        array_path, index_path = pack_paths(Path(s_path))
+        pack: np.ndarray = np.lib.format.open_memmap(str(array_path), mode='w+', dtype=np.uint8,
+                                                     shape=(total, *shapes.pop()))
+        all_names: List[str] = []
+        for names, slices in pool.imap(reorient_patient, jobs):  # In order, so that the offsets are known
+            pack[len(all_names):len(all_names) + len(names)] = slices
+            all_names += names
+        assert len(all_names) == total, (len(all_names), total)
+        pack.flush()
+        del pack
+
+    with open(index_path, 'w') as f:
+        f.write('\n'.join(all_names) + '\n')
+    print(f"Packed {total} slices into {array_path}")
 
 
 def copytree(src, dst, symlinks=False):
@@ -128,7 +176,12 @@ def get_args() -> argparse.Namespace:
     parser.add_argument('--base_folder', type=str, required=True)
     parser.add_argument('--folders', type=str, default=None)
     parser.add_argument('--save_folder', type=str, required=True)
-    parser.add_argument('--rot', type=str, default='rot')
+    parser.add_argument('--rot', type=str, default='rot', choices=['rot', 'rot_back'])
+    parser.add_argument('--pad', type=int, default=110,
+                        help="Zeros added on both sides of the slice axis by rot, and cropped by rot_back")
+    parser.add_argument('--packed', action='store_true',
+                        help="Write a pack (save_folder/x.npy and its index) instead of png slices")
+    parser.add_argument('--workers', type=int, default=None, help="Processes, one patient each. All cpus by default")
     parser.add_argument('--grp_regex', type=str, required=True)
     args = parser.parse_args()
     print(args)
@@ -1,21 +1,29 @@
 #!/usr/bin/env python3.6
 
+import os
+import time
+import socket
 from random import random
+from shutil import copytree, rmtree
 from pathlib import Path
+from tempfile import mkdtemp
 from multiprocessing.pool import Pool
+from threading import BoundedSemaphore
+from concurrent.futures import Future, ThreadPoolExecutor
 
-from typing import Any, Callable, Iterable, List, Set, Tuple, TypeVar, Union
+from typing import Any, Callable, Dict, Iterable, List, Set, Tuple, TypeVar, Union
 
 import torch
 import numpy as np
 from tqdm import tqdm
 from torch import einsum
 from torch import Tensor
-from functools import partial, reduce
+from functools import partial, reduce, wraps
 from skimage.io import imsave
 from PIL import Image, ImageOps
-from scipy.spatial.distance import directed_hausdorff
+from scipy.ndimage import binary_erosion, distance_transform_edt
 import torch.nn as nn
+import torch.nn.functional as F
 #import pydensecrf.densecrf as dcrf
 #from pydensecrf.utils import unary_from_labels
 #from pydensecrf.utils import unary_from_softmax
@@ -71,44 +79,119 @@ def batch_soft_size(a: Tensor) -> Tensor:
 
 
 # Assert utils
+# How thoroughly the invariants of the hot path (simplex, one_hot, sset) are checked:
+# - off: not at all, they always hold
+# - cheap: only with min/max range checks, when the invariant has such a variant. Reading the min/max back still
+#   synchronizes the device at each call, only without the copy of the whole tensor
+# - sampled: the full check once every `every` calls of each invariant, and no check at all (no sync) otherwise
+# - full: set-based checks, that copy the tensors to the host and thus synchronize the device at each call
+# The default comes from the CDA_VALIDATION (and CDA_VALIDATION_EVERY) environment variables, so that it also reaches
+# spawned dataloader workers; main.py sets it from --validation.
+VALIDATION_LEVELS: List[str] = ["off", "cheap", "sampled", "full"]
+__validation_level__: str = os.environ.get("CDA_VALIDATION", "full")
+__validation_every__: int = int(os.environ.get("CDA_VALIDATION_EVERY", 100))
+assert __validation_level__ in VALIDATION_LEVELS, (__validation_level__, VALIDATION_LEVELS)
+
+
+def set_validation_level(level: str, every: int = 100) -> None:
+    global __validation_level__, __validation_every__
+    assert level in VALIDATION_LEVELS, (level, VALIDATION_LEVELS)
+    assert every >= 1, every
+    __validation_level__ = level
+    __validation_every__ = every
+
+    os.environ["CDA_VALIDATION"] = level
+    os.environ["CDA_VALIDATION_EVERY"] = str(every)
+
+
+def get_validation_level() -> str:
+    return __validation_level__
+
+
+def invariant(cheap: Callable[..., bool] = None) -> Callable:
+    def decorator(full: Callable[..., bool]) -> Callable[..., bool]:
+        calls: List[int] = [0]
+
+        @wraps(full)
+        def check(*args, **kwargs) -> bool:
+            level: str = __validation_level__
+            if level == "sampled":
+                calls[0] += 1
+                level = "full" if calls[0] % __validation_every__ == 1 or __validation_every__ == 1 else "off"
+
+            if level == "full":
+                return full(*args, **kwargs)
+            if level == "cheap" and cheap is not None:
+                return cheap(*args, **kwargs)
+            return True
+
+        return check
+
+    return decorator
+
+
+def in_range(a: Tensor, low: int, high: int) -> bool:
+    return bool(a.min() >= low) and bool(a.max() <= high)
+
+
 def uniq(a: Tensor) -> Set:
     return set(torch.unique(a.cpu()).numpy())
 
 
-def sset(a: Tensor, sub: Iterable) -> bool:
+def __sset__(a: Tensor, sub: Iterable) -> bool:
     return uniq(a).issubset(sub)
 
 
+def __simplex__(t: Tensor, axis=1, dtype=torch.float32) -> bool:
+    _sum = t.sum(axis).type(dtype)
+    _ones = torch.ones_like(_sum, dtype=_sum.dtype)
+    return torch.allclose(_sum, _ones)
+
+
+# The subsets are always contiguous ranges of labels, e.g. [0, 1] or range(C)
+@invariant(cheap=lambda a, sub: in_range(a, min(sub), max(sub)))
+def sset(a: Tensor, sub: Iterable) -> bool:
+    return __sset__(a, sub)
+
+
 def eq(a: Tensor, b) -> bool:
     return torch.eq(a, b).all()
 
 
+@invariant()
 def simplex(t: Tensor, axis=1, dtype=torch.float32) -> bool:
-    _sum = t.sum(axis).type(dtype)
-    _ones = torch.ones_like(_sum, dtype=_sum.dtype)
-    return torch.allclose(_sum, _ones)
+    return __simplex__(t, axis, dtype)
 
 
+@invariant(cheap=lambda t, axis=1, dtype=torch.float32: in_range(t, 0, 1))
 def one_hot(t: Tensor, axis=1, dtype=torch.float32) -> bool:
-    return simplex(t, axis, dtype) and sset(t, [0, 1])
+    return __simplex__(t, axis, dtype) and __sset__(t, [0, 1])
 
 
 # # Metrics and shitz
-def meta_dice(sum_str: str, label: Tensor, pred: Tensor, smooth: float = 1e-8, dtype=torch.float32) -> float:
+def meta_cards(sum_str: str, label: Tensor, pred: Tensor, dtype=torch.float32) -> Tuple[Tensor, Tensor, Tensor]:
     assert label.shape == pred.shape
     assert one_hot(label)
     assert one_hot(pred)
 
-    inter_size: Tensor = einsum(sum_str, [intersection(label, pred)]).type(dtype)
-    sum_sizes: Tensor = (einsum(sum_str, [label]) + einsum(sum_str, [pred])).type(dtype)
+    inter_card: Tensor = einsum(sum_str, [intersection(label, pred)]).type(dtype)
+    card_label: Tensor = einsum(sum_str, [label]).type(dtype)
+    card_pred: Tensor = einsum(sum_str, [pred]).type(dtype)
+
+    return inter_card, card_label, card_pred
 
-    dices: Tensor = (2 * inter_size + smooth) / (sum_sizes + smooth)
+
+def meta_dice(sum_str: str, label: Tensor, pred: Tensor, smooth: float = 1e-8, dtype=torch.float32) -> float:
+    inter_size, card_label, card_pred = meta_cards(sum_str, label, pred, dtype)
+
+    dices: Tensor = (2 * inter_size + smooth) / (card_label + card_pred + smooth)
 
     return dices
 
 
 dice_coef = partial(meta_dice, "bcwh->bc")
 dice_batch = partial(meta_dice, "bcwh->c")  # used for 3d dice
+dice_cards = partial(meta_cards, "bcwh->bc")  # per slice cardinalities, accumulated for the 3d dice
 
 
 def intersection(a: Tensor, b: Tensor) -> Tensor:
@@ -143,51 +226,197 @@ def class2one_hot(seg: Tensor, C: int) -> Tensor:
 
     b, w, h = seg.shape  # type: Tuple[int, int, int]
 
-    res = torch.stack([seg == c for c in range(C)], dim=1).type(torch.int32)
-    assert res.shape == (b, C, w, h)
-    assert one_hot(res)
+    res = torch.zeros((b, C, w, h), dtype=torch.int32, device=seg.device)
+    res.scatter_(1, seg[:, None, ...].type(torch.int64), 1)
+    assert res.shape == (b, C, w, h)  # One-hot by construction
 
     return res
 
 
 def probs2one_hot(probs: Tensor) -> Tensor:
     _, C, _, _ = probs.shape
-    assert simplex(probs)
 
+    # probs2class and class2one_hot already check their inputs
     res = class2one_hot(probs2class(probs), C)
     assert res.shape == probs.shape
-    assert one_hot(res)
 
     return res
 
 
 # Misc utils
-def save_images(segs: Tensor, names: Iterable[str], root: str, mode: str, iter: int, remap: True) -> None:
-    b, w, h = segs.shape  # Since we have the class numbers, we do not need a C axis
+def write_image(seg: np.ndarray, save_path: Path, remap: bool, fmt: str = "png", compress_level: int = 6) -> None:
+    if remap:
+        #assert sset(seg, list(range(2)))
+        seg = seg.copy()
+        seg[seg == 1] = 255
+    save_path.parent.mkdir(parents=True, exist_ok=True)
 
-    for seg, name in zip(segs, names):
-        seg = seg.cpu().numpy()
-        if remap:
-            #assert sset(seg, list(range(2)))
-            seg[seg == 1] = 255
-        save_path = Path(root, f"iter{iter:03d}", mode, name).with_suffix(".png")
-        save_path.parent.mkdir(parents=True, exist_ok=True)
+    if fmt == "png":
+        # Lower compression levels are much faster to encode, for slightly bigger files
+        Image.fromarray(seg.astype(np.uint8)).save(save_path.with_suffix(".png"), compress_level=compress_level)
+    elif fmt == "npy":
+        np.save(save_path.with_suffix(".npy"), seg)
+    else:
+        raise ValueError(fmt)
 
-        imsave(str(save_path), seg)
 
-# Misc utils
-def save_images_inf(segs: Tensor, names: Iterable[str], root: str, mode: str, remap: True) -> None:
+def save_images(segs: Tensor, names: Iterable[str], root: str, mode: str, iter: int, remap: True,
+                fmt: str = "png", compress_level: int = 6) -> None:
     b, w, h = segs.shape  # Since we have the class numbers, we do not need a C axis
 
-    for seg, name in zip(segs, names):
-        seg = seg.cpu().numpy()
-        if remap:
-            #assert sset(seg, list(range(2)))
-            seg[seg == 1] = 255
-        save_path = Path(root, mode, name).with_suffix(".png")
-        save_path.parent.mkdir(parents=True, exist_ok=True)
+    for seg, name in zip(segs.type(torch.uint8).cpu().numpy(), names):
+        save_path = Path(root, f"iter{iter:03d}", mode, name)
+        write_image(seg, save_path, remap, fmt, compress_level)
 
-        imsave(str(save_path), seg)
+# Misc utils
+def save_images_inf(segs: Tensor, names: Iterable[str], root: str, mode: str, remap: True,
+                    fmt: str = "png", compress_level: int = 6) -> None:
+    b, w, h = segs.shape  # Since we have the class numbers, we do not need a C axis
+
+    for seg, name in zip(segs.type(torch.uint8).cpu().numpy(), names):
+        save_path = Path(root, mode, name)
+        write_image(seg, save_path, remap, fmt, compress_level)
+
+
+class AsyncImageWriter():
+    """
+    Same as save_images, but the encoding and writing happen in background threads, fed through a bounded queue.
+    Only the device to host copy stays in the caller. flush() waits for everything submitted so far.
+    """
+    def __init__(self, workers: int = 2, max_pending: int = 256, fmt: str = "png", compress_level: int = 6) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = BoundedSemaphore(max_pending)  # Blocks the caller when the writers lag behind
+        self.futures: List[Future] = []
+        self.fmt: str = fmt
+        self.compress_level: int = compress_level
+
+    def submit(self, segs: Tensor, names: Iterable[str], root: str, mode: str, iter: int, remap: True) -> None:
+        for seg, name in zip(segs.type(torch.uint8).cpu().numpy(), names):
+            self.slots.acquire()
+            future: Future = self.executor.submit(write_image, seg, Path(root, f"iter{iter:03d}", mode, name),
+                                                  remap, self.fmt, self.compress_level)
+            future.add_done_callback(lambda _: self.slots.release())
+            self.futures.append(future)
+
+    def flush(self) -> None:
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()  # Re-raise the errors of the writers, if any
+
+    def close(self) -> None:
+        self.flush()
+        self.executor.shutdown()
+
+
+def trash_in_use(trash: Path) -> bool:
+    # Whether the run that owns a trash folder .trash-<host>-<pid>-XXXX (see EpochArtifacts) is still alive. Only
+    # known for the runs of this host, the other ones are assumed alive. Older .trash folders had no owner
+    if not trash.name.startswith(".trash-"):
+        return False
+    parts: List[str] = trash.name.split("-")  # The hostname can contain dashes, the mkdtemp suffix cannot
+    if len(parts) < 4 or not parts[-2].isdigit() or "-".join(parts[1:-2]) != socket.gethostname():
+        return True
+
+    try:
+        os.kill(int(parts[-2]), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # Alive, but of another user
+        return True
+    return True
+
+
+class EpochArtifacts():
+    """
+    The predictions of an epoch are written in the staging folder root/iterNNN. At the end of the epoch, it is
+    promoted to root/best_epoch_3d or root/last_epoch with a rename (hardlinks when it is both), instead of a copy.
+    Stale folders are renamed into a trash folder of their own for each run, root/.trash-<host>-<pid>-XXXX, and
+    deleted by a background thread. The trash folder itself is removed by close().
+    """
+    def __init__(self, root: str) -> None:
+        self.root: Path = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.collector = ThreadPoolExecutor(max_workers=1)
+        self.n_trashed: int = 0
+
+        # Trash of interrupted runs: never reused, so that its deletion cannot race with the new discards
+        leftovers: List[Path] = [p for p in self.root.glob(".trash*") if not trash_in_use(p)]
+        self.trash: Path = Path(mkdtemp(prefix=f".trash-{socket.gethostname()}-{os.getpid()}-", dir=self.root))
+        for leftover in leftovers:
+            self.collector.submit(rmtree, leftover, True)
+
+    def staging(self, epoch: int) -> Path:
+        return Path(self.root, f"iter{epoch:03d}")
+
+    def discard(self, folder: Path) -> None:
+        if not folder.exists():
+            return
+
+        # Renaming is instantaneous, the actual deletion happens in the background. The trash is new to this run,
+        # so the counter alone keeps the names unique
+        trashed: Path = Path(self.trash, f"{folder.name}_{self.n_trashed}")
+        self.n_trashed += 1
+        os.replace(folder, trashed)
+        self.collector.submit(rmtree, trashed, True)
+
+    def promote(self, epoch: int, name: str, keep_staging: bool = False) -> None:
+        staging: Path = self.staging(epoch)
+        target: Path = Path(self.root, name)
+        self.discard(target)
+        if not staging.exists():
+            return
+
+        if keep_staging:
+            copytree(staging, target, copy_function=os.link)
+        else:
+            os.replace(staging, target)  # Same filesystem: atomic
+
+    def end_epoch(self, epoch: int, is_best: bool, is_last: bool) -> None:
+        if is_best:
+            self.promote(epoch, "best_epoch_3d", keep_staging=is_last)
+        if is_last:
+            self.promote(epoch, "last_epoch")
+        self.discard(self.staging(epoch))  # Neither best nor last
+
+    def close(self) -> None:
+        self.collector.shutdown(wait=True)
+        rmtree(self.trash, True)
+
+
+class StageTimer():
+    """
+    Wall time spent in each stage of an epoch: lap(stage) charges the time elapsed since the previous lap to the
+    stage. The device is synchronized at each lap so that asynchronous kernels are charged to the stage that
+    launched them, which is why it does nothing unless enabled.
+    """
+    def __init__(self, device: torch.device, enabled: bool = False) -> None:
+        self.device: torch.device = device
+        self.enabled: bool = enabled
+        self.totals: Dict[str, float] = {}
+        self.last: float = 0
+
+    def now(self) -> float:
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def start(self) -> None:
+        if self.enabled:
+            self.last = self.now()
+
+    def lap(self, stage: str) -> None:
+        if not self.enabled:
+            return
+
+        t: float = self.now()
+        self.totals[stage] = self.totals.get(stage, 0) + t - self.last
+        self.last = t
+
+    def summary(self, prefix: str) -> Dict[str, float]:
+        # Seconds per stage since the last call, e.g. {"tra_time_backward": 12.3, ...}
+        res: Dict[str, float] = {f"{prefix}_{stage}": total for (stage, total) in self.totals.items()}
+        self.totals = {}
+        return res
 
 
 def augment(*arrs: Union[np.ndarray, Image.Image]) -> List[Image.Image]:
@@ -203,6 +432,45 @@ def augment(*arrs: Union[np.ndarray, Image.Image]) -> List[Image.Image]:
     return imgs
 
 
+def augment_batch(image: Tensor, *masks: Tensor, p: float = 0.5, max_angle: float = 45) -> Tuple[Tensor, ...]:
+    """
+    Batched counterpart of augment, on the device of the batch: each sample is independently flipped, mirrored and
+    rotated by up to max_angle degrees, each with probability p, with a single grid_sample per tensor.
+    The image is interpolated bilinearly, the one-hot masks (bcwh) with nearest. What comes from outside of the
+    slice is zeros for the image, and background for the masks.
+    """
+    b, _, h, w = image.shape
+    device = image.device
+
+    def draw() -> Tensor:
+        return torch.rand(b, device=device) < p
+
+    ones: Tensor = torch.ones(b, device=device)
+    flip: Tensor = torch.where(draw(), -ones, ones)
+    mirror: Tensor = torch.where(draw(), -ones, ones)
+    angle: Tensor = (torch.rand(b, device=device) * 2 - 1) * (max_angle * np.pi / 180) * draw()
+    cos, sin = angle.cos(), angle.sin()
+
+    # Output to input coordinates, normalized to [-1, 1]: flips, then rotation in pixel space (thus the aspect ratio)
+    theta: Tensor = torch.zeros((b, 2, 3), dtype=torch.float32, device=device)
+    theta[:, 0, 0] = cos * mirror
+    theta[:, 0, 1] = -sin * (h / w) * flip
+    theta[:, 1, 0] = sin * (w / h) * mirror
+    theta[:, 1, 1] = cos * flip
+    grid: Tensor = F.affine_grid(theta, [b, 1, h, w], align_corners=False)
+
+    res: List[Tensor] = [F.grid_sample(image.float(), grid, mode="bilinear", padding_mode="zeros",
+                                       align_corners=False).type(image.dtype)]
+    for mask in masks:
+        sampled: Tensor = F.grid_sample(mask.float(), grid, mode="nearest", padding_mode="zeros",
+                                        align_corners=False)
+        sampled[:, 0] += (sampled.sum(dim=1) == 0).type(sampled.dtype)  # Background outside of the slice
+        assert one_hot(sampled)
+        res.append(sampled.type(mask.dtype))
+
+    return tuple(res)
+
+
 def mask_resize(t, new_w):
     b, c, h, w = t.shape
     new_t = t
@@ -233,28 +501,81 @@ def resize_im(t, new_w):
     return new_t
 
 
-def haussdorf(preds: Tensor, target: Tensor, dtype=torch.float32) -> Tensor:
+def haussdorf(preds: Tensor, target: Tensor, dtype=torch.float32, percentile: float = 100,
+              processes: int = 1) -> Tensor:
     assert preds.shape == target.shape
     assert one_hot(preds)
     assert one_hot(target)
 
     B, C, _, _ = preds.shape
 
-    res = torch.zeros((B, C), dtype=dtype, device=preds.device)
     n_pred = preds.cpu().numpy()
     n_target = target.cpu().numpy()
 
-    for b in range(B):
-        for c in range(C):
-            res[b, c] = numpy_haussdorf(n_pred[b, c], n_target[b, c])
+    pairs: List[Tuple[np.ndarray, np.ndarray]] = [(n_pred[b, c], n_target[b, c]) for b in range(B) for c in range(C)]
+    distances: List[float] = batch_haussdorf(pairs, percentile, processes)
+
+    return torch.tensor(distances, dtype=dtype, device=preds.device).reshape(B, C)
+
+
+def volumes_haussdorf(volumes: Iterable[Tuple[np.ndarray, np.ndarray]], C: int, percentile: float = 100,
+                      processes: int = 1) -> np.ndarray:
+    # (seg, gt) class maps of any dimension, e.g. the 3d volume of each patient; returns (n_volumes, C)
+    pairs: List[Tuple[np.ndarray, np.ndarray]] = [(seg == c, gt == c) for (seg, gt) in volumes for c in range(C)]
+    distances: List[float] = batch_haussdorf(pairs, percentile, processes)
+
+    return np.array(distances, dtype=np.float64).reshape(-1, C)
+
+
+# Created on first use and kept for the whole run, instead of forking new workers at each evaluation
+__haussdorf_pools__: Dict[int, Pool] = {}
 
-    return res
 
+def haussdorf_pool(processes: int) -> Pool:
+    if processes not in __haussdorf_pools__:
+        __haussdorf_pools__[processes] = Pool(processes)
 
-def numpy_haussdorf(pred: np.ndarray, target: np.ndarray) -> float:
-    assert len(pred.shape) == 2
+    return __haussdorf_pools__[processes]
+
+
+def batch_haussdorf(pairs: List[Tuple[np.ndarray, np.ndarray]], percentile: float = 100,
+                    processes: int = 1) -> List[float]:
+    fn: Callable = partial(numpy_haussdorf, percentile=percentile)
+    if processes > 1 and len(pairs) > 1:
+        pool: Pool = haussdorf_pool(processes)
+        return pool.starmap(fn, pairs, chunksize=max(1, len(pairs) // (4 * processes)))
+
+    return [fn(pred, target) for (pred, target) in pairs]
+
+
+def contour(mask: np.ndarray) -> np.ndarray:
+    # Foreground pixels (voxels in 3d) touching the background, or the border of the image
+    return mask & ~binary_erosion(mask, border_value=0)
+
+
+def surface_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # Distance of each contour point of a to the closest contour point of b
+    return distance_transform_edt(~contour(b))[contour(a)]
+
+
+def numpy_haussdorf(pred: np.ndarray, target: np.ndarray, percentile: float = 100) -> float:
+    """
+    Symmetric Hausdorff distance between the contours of two binary masks (2d slices or 3d volumes), computed with
+    distance transforms: the max of the two directed distances. With percentile=95 (HD95), each directed distance
+    is the 95th percentile of its own surface distances. 0 when both masks are empty, nan when only one is.
+    """
     assert pred.shape == target.shape
-    return max(directed_hausdorff(pred, target)[0], directed_hausdorff(target, pred)[0])
+    pred, target = pred.astype(bool), target.astype(bool)
+
+    if not pred.any() and not target.any():
+        return 0.
+    if not pred.any() or not target.any():
+        return np.nan
+
+    directed: List[np.ndarray] = [surface_distances(pred, target), surface_distances(target, pred)]
+    if percentile >= 100:
+        return float(max(d.max() for d in directed))
+    return float(max(np.percentile(d, percentile) for d in directed))
 
 
 def interp(input):
@@ -333,6 +654,18 @@ def plot_as_viewer(gt_seg, s_seg, t_seg, s_im, t_im):
     fig.suptitle('gt, source seg, target seg', fontsize=12)
 
 
+def lr_poly(base_lr: float, i_iter: int, max_iter: int, power: float) -> float:
+    return base_lr * (max(0., 1 - float(i_iter) / max_iter) ** power)
+
+
+def adjust_learning_rate(optimizer: Any, i_iter: int, lr: float, num_steps: int, power: float) -> float:
+    new_lr: float = lr_poly(lr, i_iter, num_steps, power)
+    for param_group in optimizer.param_groups:
+        param_group['lr'] = new_lr
+
+    return new_lr
+
+
 def save_dict_to_file(dic, workdir):
     save_path = Path(workdir, 'params.txt')
     save_path.parent.mkdir(parents=True, exist_ok=True)